@@ -0,0 +1,449 @@
+# Offline benchmarks of the bot's hot paths against fake Discord objects.
+# Nothing talks to Discord: main.py is imported, its client is swapped for a
+# fake one and the handlers are called directly.
+#
+#   python benchmark.py --members 10000 100000 500000
+#   python benchmark.py --json results.json --baseline baseline.json
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import main
+import metrics
+from member_sync import sync_server_members
+from reaction_roles import ReactionRoleRegistry
+from role_queue import RoleMutationQueue
+from storage import SQLiteStorage
+
+BOT_ID = 1
+ROLE_NAMES = ("general", "singles", "doubles")
+
+
+class FakeRole:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+
+    def is_default(self):
+        return False
+
+
+class FakeMember:
+    __slots__ = ('guild', 'id', 'name', 'display_name', 'bot', '_roles')
+
+    def __init__(self, guild, user_id, roles):
+        self.guild = guild
+        self.id = user_id
+        self.name = self.display_name = f"player{user_id}"
+        self.bot = False
+        self._roles = {role.id: role for role in roles}
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    async def add_roles(self, *roles, reason=None):
+        await self.guild.api_call()
+        for role in roles:
+            self._roles[role.id] = role
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.guild.api_call()
+        for role in roles:
+            self._roles.pop(role.id, None)
+
+    async def edit(self, roles, reason=None):
+        await self.guild.api_call()
+        self._roles = {role.id: role for role in roles}
+
+
+class FakeChannel:
+
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+        self.sent = 0
+        self._next_message_id = channel_id * 1000
+
+    async def send(self, content=None, file=None, view=None):
+        await self.guild.api_call()
+        self.sent += 1
+        if file is not None:
+            file.close()
+        if view is not None:
+            view.stop()
+        self._next_message_id += 1
+        return SimpleNamespace(id=self._next_message_id,
+                               channel=self,
+                               guild=self.guild)
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id, member_count, api_latency, seed):
+        self.id = guild_id
+        self.chunked = True
+        self.api_latency = api_latency
+        self.api_calls = 0
+        self.roles = [
+            FakeRole(guild_id * 10 + i, name)
+            for i, name in enumerate(ROLE_NAMES)
+        ]
+        self.channel = FakeChannel(self, guild_id * 10)
+        rng = random.Random(seed)
+        self._members = {}
+        for i in range(member_count):
+            user_id = guild_id * 10_000_000 + i
+            roles = [role for role in self.roles if rng.random() < 0.3]
+            self._members[user_id] = FakeMember(self, user_id, roles)
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    def get_channel(self, channel_id):
+        return self.channel if channel_id == self.channel.id else None
+
+    async def create_role(self, name):
+        await self.api_call()
+        role = FakeRole(self.id * 10 + len(self.roles), name)
+        self.roles.append(role)
+        return role
+
+    async def api_call(self):
+        # Stands in for a REST round trip
+        self.api_calls += 1
+        await asyncio.sleep(self.api_latency)
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.user = SimpleNamespace(id=BOT_ID)
+        self.guilds = []
+
+    def get_guild(self, guild_id):
+        for guild in self.guilds:
+            if guild.id == guild_id:
+                return guild
+        return None
+
+
+class Bench:
+    # Fixtures for one member count
+
+    def __init__(self, members, events, repeat, api_latency, path):
+        self.members = members
+        self.events = events
+        self.repeat = repeat
+        self.api_latency = api_latency
+        self.path = path
+        self._next_guild_id = 100
+
+    async def start(self):
+        # Fresh storage, registry and queue in place of main.py's globals
+        main.client = FakeClient()
+        main.db = SQLiteStorage(self.path)
+        main.reaction_roles = ReactionRoleRegistry(main.db)
+        main.role_queue = RoleMutationQueue(
+            on_applied=main.record_role_changes, delay=main.role_queue.delay)
+        await main.db.connect()
+        main.storage_ready.set()
+
+    async def stop(self):
+        await main.db.close()
+
+    def guild(self):
+        # A new guild each time, so every run starts from the same state
+        self._next_guild_id += 1
+        guild = FakeGuild(self._next_guild_id, self.members, self.api_latency,
+                          seed=self.members)
+        main.client.guilds = [guild]
+        return guild
+
+
+async def _timed(samples, coro):
+    started = time.perf_counter()
+    await coro
+    samples.append(time.perf_counter() - started)
+
+
+# Each scenario builds its fixtures, then returns the coroutine function
+# being measured; that returns (latency samples, operation count, guild)
+
+
+async def sync_cold(bench):
+    guild = bench.guild()
+
+    async def run():
+        samples = []
+        await _timed(samples, sync_server_members(main.db, guild))
+        return samples, bench.members, guild
+
+    return run
+
+
+async def sync_warm(bench):
+    guild = bench.guild()
+    await sync_server_members(main.db, guild)
+
+    async def run():
+        samples = []
+        for _ in range(bench.repeat):
+            await _timed(samples, sync_server_members(main.db, guild))
+        return samples, bench.members * bench.repeat, guild
+
+    return run
+
+
+async def sync_churn(bench):
+    # 1% of members change roles between syncs
+    guild = bench.guild()
+    await sync_server_members(main.db, guild)
+    rng = random.Random(0)
+    members = guild.members
+
+    async def run():
+        samples = []
+        for _ in range(bench.repeat):
+            for member in rng.sample(members, max(1, len(members) // 100)):
+                role = rng.choice(guild.roles)
+                if member._roles.pop(role.id, None) is None:
+                    member._roles[role.id] = role
+            await _timed(samples, sync_server_members(main.db, guild))
+        return samples, bench.members * bench.repeat, guild
+
+    return run
+
+
+async def _reaction_payloads(bench, guild):
+    await sync_server_members(main.db, guild)
+    message = await guild.channel.send("singles or doubles")
+    await main.reaction_roles.register(message, 'singles_doubles')
+    rng = random.Random(1)
+    return [
+        SimpleNamespace(message_id=message.id,
+                        user_id=member.id,
+                        emoji=rng.choice(("1️⃣", "2️⃣")),
+                        guild_id=guild.id,
+                        member=member)
+        for member in rng.choices(guild.members, k=bench.events)
+    ]
+
+
+async def _run_reactions(handler, payloads, guild):
+    samples = []
+    for payload in payloads:
+        await _timed(samples, handler(payload))
+    # Throughput covers the role edits and database writes too
+    await main.reaction_buffer.join()
+    await main.role_queue.join()
+    await main.db.flush()
+    return samples, len(payloads), guild
+
+
+async def reaction_add(bench):
+    guild = bench.guild()
+    payloads = await _reaction_payloads(bench, guild)
+    return lambda: _run_reactions(main.on_raw_reaction_add, payloads, guild)
+
+
+async def reaction_remove(bench):
+    guild = bench.guild()
+    payloads = await _reaction_payloads(bench, guild)
+    for payload in payloads:
+        payload.member = None
+    return lambda: _run_reactions(main.on_raw_reaction_remove, payloads,
+                                  guild)
+
+
+async def database_command(bench):
+    guild = bench.guild()
+    await sync_server_members(main.db, guild)
+    channel = guild.channel
+    ctx = SimpleNamespace(channel=channel,
+                          guild=guild,
+                          author=SimpleNamespace(id=BOT_ID + 1),
+                          send=channel.send)
+
+    async def run():
+        samples = []
+        for _ in range(bench.repeat):
+            await _timed(samples, main.database.callback(ctx))
+        return samples, bench.repeat, guild
+
+    return run
+
+
+SCENARIOS = {
+    'sync_cold': sync_cold,
+    'sync_warm': sync_warm,
+    'sync_churn': sync_churn,
+    'reaction_add': reaction_add,
+    'reaction_remove': reaction_remove,
+    'database': database_command,
+}
+
+
+def _write_batches():
+    # Group commits so far, from the database timings
+    entry = metrics.DB_SECONDS.values.get(('write_batch', ))
+    return entry[2] if entry else 0
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(bench, name, memory):
+    scenario = SCENARIOS[name]
+    run = await scenario(bench)
+    gc.collect()
+    batches = _write_batches()
+    started = time.perf_counter()
+    samples, ops, guild = await run()
+    elapsed = time.perf_counter() - started
+    result = {
+        'scenario': name,
+        'members': bench.members,
+        'ops_per_s': ops / elapsed,
+        'p50_ms': percentile(samples, 0.5) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'api_calls': guild.api_calls,
+        'db_batches': _write_batches() - batches,
+        'peak_mb': None,
+    }
+    if memory:
+        # A second pass under tracemalloc, which slows everything down too
+        # much to time the first; fixtures are built before tracing starts
+        run = await scenario(bench)
+        gc.collect()
+        tracemalloc.start()
+        await run()
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+async def run_all(args):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for members in args.members:
+            bench = Bench(members, args.events, args.repeat, args.api_latency,
+                          os.path.join(directory, f"bench-{members}.db"))
+            await bench.start()
+            try:
+                for name in args.scenarios:
+                    result = await run_scenario(bench, name, args.memory)
+                    print(format_result(result), flush=True)
+                    results.append(result)
+            finally:
+                await bench.stop()
+    return results
+
+
+def format_result(result):
+    peak = result['peak_mb']
+    peak_text = f"{peak:9.1f}" if peak is not None else f"{'-':>9}"
+    return (f"{result['scenario']:<16}{result['members']:>9}"
+            f"{result['ops_per_s']:>12.0f}{result['p50_ms']:>10.3f}"
+            f"{result['p99_ms']:>10.3f}{result['api_calls']:>8}"
+            f"{result['db_batches']:>8}{peak_text}")
+
+
+def regressions(results, baseline, tolerance):
+    # Slower throughput or p99 beyond tolerance, against a previous --json
+    previous = {(r['scenario'], r['members']): r for r in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result['scenario'], result['members']))
+        if before is None:
+            continue
+        label = f"{result['scenario']} @ {result['members']}"
+        if result['ops_per_s'] < before['ops_per_s'] * (1 - tolerance):
+            found.append(f"{label}: {result['ops_per_s']:.0f} ops/s, "
+                         f"was {before['ops_per_s']:.0f}")
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            found.append(f"{label}: p99 {result['p99_ms']:.3f}ms, "
+                         f"was {before['p99_ms']:.3f}ms")
+    return found
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot's hot paths offline")
+    parser.add_argument('--members',
+                        type=int,
+                        nargs='+',
+                        default=[10_000, 100_000, 500_000],
+                        help="guild sizes to run every scenario at")
+    parser.add_argument('--scenarios',
+                        nargs='+',
+                        choices=list(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument('--events',
+                        type=int,
+                        default=5000,
+                        help="reactions per reaction scenario")
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=5,
+                        help="runs per sync and database scenario")
+    parser.add_argument('--api-latency',
+                        type=float,
+                        default=0.0,
+                        help="seconds each fake Discord API call takes")
+    parser.add_argument('--no-memory',
+                        dest='memory',
+                        action='store_false',
+                        help="skip the peak memory pass")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline',
+                        help="fail if slower than the results in this file")
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.25,
+                        help="allowed slowdown against --baseline")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    print(f"{'scenario':<16}{'members':>9}{'ops/s':>12}{'p50 ms':>10}"
+          f"{'p99 ms':>10}{'api':>8}{'db':>8}{'peak MB':>9}")
+    results = asyncio.run(run_all(args))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Regression: {line}")
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
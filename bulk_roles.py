@@ -0,0 +1,187 @@
+# Bulk promote/demote: one role added to or removed from many members
+import asyncio
+import csv
+import io
+import logging
+import re
+import time
+
+import discord
+from discord.ext import commands
+
+from lean_members import resolve_members
+from role_index import has_role
+from storage import ROLE_COLUMNS
+
+log = logging.getLogger(__name__)
+
+# CSV attachments larger than this are refused
+CSV_MAX_BYTES = 1_000_000
+# Header cells that mark a CSV's first row as column names
+CSV_HEADERS = {'id', 'user_id', 'member', 'username', 'name'}
+# Seconds between edits of the progress message
+PROGRESS_INTERVAL = 2.0
+# Failed members listed by name in the summary
+SUMMARY_FAILURES = 10
+
+
+# A user mention (<@id> or <@!id>) or a raw user ID
+MEMBER_REFERENCE = re.compile(r'<@!?(\d{15,20})>|(\d{15,20})')
+
+
+class MentionedMember(commands.Converter):
+    # Targets of promote/demote. Only mentions and IDs are accepted: looked
+    # up by name, the first word of the role name could match (or, when
+    # uncached, cost a gateway query for) a member named like it.
+
+    async def convert(self, ctx, argument):
+        match = MEMBER_REFERENCE.fullmatch(argument)
+        if match is None:
+            raise commands.BadArgument("Not a member mention or ID")
+        user_id = int(match.group(1) or match.group(2))
+        members = await resolve_members(ctx.guild, [user_id])
+        if not members:
+            raise commands.MemberNotFound(argument)
+        return members[0]
+
+
+class SourceRole(commands.Converter):
+    # "from:<role name>" picks everyone who has that role
+
+    async def convert(self, ctx, argument):
+        if not argument.startswith('from:') or argument == 'from:':
+            raise commands.BadArgument("Not a source role")
+        return argument[len('from:'):]
+
+
+async def members_with_role(guild, role, db):
+    # A fully chunked guild's cache is authoritative; otherwise the flag
+    # index answers for the tracked roles
+    if not guild.chunked and role.name in ROLE_COLUMNS and db.ready:
+        user_ids = await db.members_with_role(guild.id, role.name)
+        return await resolve_members(guild, user_ids)
+    return list(role.members)
+
+
+async def members_from_csv(guild, attachment):
+    # One member per row, named in the first cell by ID, mention or username
+    # (usernames only match cached members). Returns the members found and
+    # the cells that matched nobody.
+    if attachment.size > CSV_MAX_BYTES:
+        raise ValueError(f"{attachment.filename} is over "
+                         f"{CSV_MAX_BYTES // 1000} KB")
+    text = (await attachment.read()).decode('utf-8-sig', errors='replace')
+    members = []
+    unknown = []
+    # ID -> cell it came from; IDs are looked up together at the end
+    user_ids = {}
+    for line, row in enumerate(csv.reader(io.StringIO(text))):
+        cell = row[0].strip() if row else ''
+        if not cell or (line == 0 and cell.lower() in CSV_HEADERS):
+            continue
+        user_id = cell.strip('<@!>')
+        if user_id.isdigit():
+            user_ids[int(user_id)] = cell
+            continue
+        member = guild.get_member_named(cell)
+        if member is None:
+            unknown.append(cell)
+        else:
+            members.append(member)
+    found = await resolve_members(guild, list(user_ids))
+    for member in found:
+        user_ids.pop(member.id, None)
+    unknown += user_ids.values()
+    return members + found, unknown
+
+
+class BulkRoleJob:
+
+    def __init__(self, members, role, add, limit, workers, reason=None):
+        self.members = members
+        self.role = role
+        self.add = add
+        # Shared with the reaction role queue, so bulk edits and reactions
+        # stay inside the same per-guild rate limit between them
+        self.limit = limit
+        self.workers = workers
+        self.reason = reason
+        self.changed = 0
+        self.skipped = 0
+        # [(member, reason)] for the edits that failed
+        self.failed = []
+        # Set when the bot can't edit this role at all
+        self.forbidden = False
+
+    @property
+    def done(self):
+        return self.changed + self.skipped + len(self.failed)
+
+    async def run(self, on_progress=None):
+        pending = iter(self.members)
+        reported = time.monotonic()
+
+        async def worker():
+            nonlocal reported
+            # Workers take members from one shared iterator until it runs out
+            for member in pending:
+                if self.forbidden:
+                    return
+                await self._apply(member)
+                now = time.monotonic()
+                if on_progress and now - reported >= PROGRESS_INTERVAL:
+                    reported = now
+                    await on_progress(self)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+
+    async def _apply(self, member):
+        if has_role(member, self.role) == self.add:
+            self.skipped += 1
+            return
+        try:
+            async with self.limit:
+                if self.add:
+                    await member.add_roles(self.role, reason=self.reason)
+                else:
+                    await member.remove_roles(self.role, reason=self.reason)
+            self.changed += 1
+        except discord.Forbidden:
+            # Role hierarchy and permissions are the same for every member
+            self.forbidden = True
+            self.failed.append((member, "missing permissions"))
+        except discord.HTTPException as e:
+            self.failed.append((member, e.text or f"HTTP {e.status}"))
+            log.warning('Error in bulk role edit: %s',
+                        e,
+                        extra={
+                            'guild': member.guild.id,
+                            'member': member.id,
+                            'role': self.role.name
+                        })
+
+    def progress(self, verb):
+        return f"{verb} '{self.role.name}': {self.done}/{len(self.members)}"
+
+    def summary(self, verb, unknown=()):
+        lines = [
+            f"{verb} '{self.role.name}' for {self.changed} of "
+            f"{len(self.members)} members."
+        ]
+        if self.skipped:
+            lines.append(f"{self.skipped} already "
+                         f"{'had' if self.add else 'lacked'} it.")
+        if self.forbidden:
+            lines.append("Stopped: I don't have permission to manage that "
+                         "role.")
+        if self.failed:
+            names = ', '.join(f"{member.display_name} ({reason})"
+                              for member, reason in
+                              self.failed[:SUMMARY_FAILURES])
+            more = len(self.failed) - SUMMARY_FAILURES
+            lines.append(f"{len(self.failed)} failed: {names}"
+                         f"{f' and {more} more' if more > 0 else ''}")
+        if unknown:
+            cells = ', '.join(unknown[:SUMMARY_FAILURES])
+            lines.append(f"{len(unknown)} CSV rows matched no member: {cells}")
+        return '\n'.join(lines)[:2000]
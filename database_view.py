@@ -0,0 +1,130 @@
+# Paginated rendering of the server_members table for `$bot database`
+import discord
+
+# Discord rejects messages over 2000 characters
+MESSAGE_LIMIT = 2000
+# Rows fetched per keyset page; a page is trimmed further to fit MESSAGE_LIMIT
+PAGE_ROWS = 20
+
+HEADER = ("**Tennis Database Contents:**\n```"
+          "ID | Username | General | Singles | Doubles\n" + "-" * 80 + "\n")
+FOOTER = "```"
+
+
+def format_row(row):
+    general_text = f"{row[2]} {'(True)' if row[2] == 1 else '(False)'}"
+    singles_text = f"{row[3]} {'(True)' if row[3] == 1 else '(False)'}"
+    doubles_text = f"{row[4]} {'(True)' if row[4] == 1 else '(False)'}"
+    return f"{row[0]} | {row[1]} | {general_text} | {singles_text} | {doubles_text}\n"
+
+
+def render_page(rows, footer=""):
+    # Render as many rows as fit in one message. Returns the text and the id
+    # of the last rendered row, which is where the next page starts.
+    response = HEADER
+    budget = MESSAGE_LIMIT - len(FOOTER) - len(footer)
+    last_id = None
+    for row in rows:
+        line = format_row(row)
+        if len(response) + len(line) > budget and last_id is not None:
+            break
+        response += line
+        last_id = row[0]
+    return response + FOOTER + footer, last_id
+
+
+class DatabaseView(discord.ui.View):
+
+    def __init__(self, db, guild_id, author_id):
+        super().__init__(timeout=180)
+        self.db = db
+        self.guild_id = guild_id
+        self.author_id = author_id
+        # Keyset cursors: id each visited page starts after
+        self.starts = [0]
+        self.next_start = None
+        self.empty = False
+
+    async def render(self):
+        # One extra row tells us whether there is a next page. Nothing else
+        # is read (not even a row count), so a page costs the same however
+        # large the table is; the whole table is an explicit `$bot export`.
+        rows = await self.db.fetch_members_page(self.guild_id,
+                                                self.starts[-1],
+                                                PAGE_ROWS + 1)
+        self.empty = not rows and len(self.starts) == 1
+        footer = (f"\nPage {len(self.starts)} · "
+                  f"`$bot export` for the whole table")
+        text, last_id = render_page(rows[:PAGE_ROWS], footer)
+        self.next_start = last_id
+        self.previous_page.disabled = len(self.starts) == 1
+        self.next_page.disabled = not rows or last_id == rows[-1][0]
+        return text
+
+    async def interaction_check(self, interaction):
+        # Only whoever ran the command can page through it
+        return interaction.user.id == self.author_id
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        if len(self.starts) > 1:
+            self.starts.pop()
+        await interaction.response.edit_message(content=await self.render(),
+                                                view=self)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        if self.next_start is not None:
+            self.starts.append(self.next_start)
+        await interaction.response.edit_message(content=await self.render(),
+                                                view=self)
+
+
+async def send_database(channel, db, guild_id, author_id):
+    view = DatabaseView(db, guild_id, author_id)
+    content = await view.render()
+    if view.empty:
+        view.stop()
+        await channel.send("The database is empty!")
+        return
+
+    kwargs = {}
+    if view.next_page.disabled:
+        view.stop()
+    else:
+        kwargs['view'] = view
+    await channel.send(content, **kwargs)
+
+
+async def send_member(channel, db, guild_id, member):
+    state = await db.get_member_state(guild_id, member.id)
+    if state is None:
+        await channel.send(f"{member.display_name} isn't in the database.")
+        return
+    await channel.send(HEADER + format_row((member.id, *state)) + FOOTER)
+
+
+def render_summaries(rows, guild_names):
+    # One line per guild, largest first, as many as fit in one message
+    rows = sorted(rows, key=lambda row: -row[1])
+    total = sum(row[1] for row in rows)
+    response = (f"**All guilds:** {len(rows)} guilds · {total} members\n```"
+                "Guild | Members | General | Singles | Doubles\n" + "-" * 80 +
+                "\n")
+    budget = MESSAGE_LIMIT - len(FOOTER)
+    for guild_id, members, general, singles, doubles in rows:
+        name = guild_names.get(guild_id, guild_id)
+        line = f"{name} | {members} | {general} | {singles} | {doubles}\n"
+        if len(response) + len(line) > budget:
+            break
+        response += line
+    return response + FOOTER
+
+
+async def send_guild_summaries(channel, db, guild_names):
+    # Every guild in storage, including those on other processes' shards
+    rows = await db.guild_summaries()
+    if not rows:
+        await channel.send("The database is empty!")
+        return
+    await channel.send(render_summaries(rows, guild_names))
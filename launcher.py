@@ -0,0 +1,161 @@
+# Runs the bot as several processes, each with its own range of shards.
+#
+#   python launcher.py --processes 4             # Discord's recommended count
+#   python launcher.py --processes 4 --shards 16
+import argparse
+import asyncio
+import logging
+import math
+import os
+import signal
+import sys
+
+import aiohttp
+from dotenv import load_dotenv
+
+from logs import log_handler
+from storage import stored_shard_count
+
+log = logging.getLogger('launcher')
+
+GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+# Discord allows max_concurrency shard logins every 5 seconds
+IDENTIFY_INTERVAL = 5
+# Seconds before restarting a process that exited on its own
+RESTART_DELAY = 10
+
+
+async def gateway_info(token):
+    # Recommended shard count and how many shards may log in at once
+    headers = {'Authorization': f'Bot {token}'}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data['shards'], data['session_start_limit']['max_concurrency']
+
+
+def pinned_shard_count():
+    # SQLite shard files only hold the right guilds for the shard count they
+    # were written with, so once they exist that count is kept
+    if (os.getenv('STORAGE_BACKEND') or 'sqlite').lower() != 'sqlite':
+        return None
+    return stored_shard_count(os.getenv('SQLITE_PATH') or 'tennis.db')
+
+
+def shard_ranges(shard_count, processes):
+    # Contiguous, near-equal ranges, one per process
+    processes = min(processes, shard_count)
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for worker in range(processes):
+        end = start + size + (1 if worker < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Worker:
+
+    def __init__(self, number, shard_ids, shard_count, delay):
+        self.number = number
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        # Seconds to wait before the first start, so the processes don't all
+        # log in at once and trip the identify rate limit
+        self.delay = delay
+        self.process = None
+        self.stopping = False
+
+    def env(self):
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.shard_count),
+                   SHARD_IDS=','.join(map(str, self.shard_ids)))
+        # Each process serves metrics on its own port
+        if os.getenv('METRICS_PORT'):
+            env['METRICS_PORT'] = str(
+                int(os.getenv('METRICS_PORT')) + self.number)
+        return env
+
+    async def run(self):
+        await asyncio.sleep(self.delay)
+        while not self.stopping:
+            log.info('Starting process',
+                     extra={
+                         'worker': self.number,
+                         'shards': f'{self.shard_ids[0]}-{self.shard_ids[-1]}'
+                     })
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, MAIN, env=self.env())
+            code = await self.process.wait()
+            if self.stopping:
+                break
+            log.warning('Process exited, restarting',
+                        extra={
+                            'worker': self.number,
+                            'code': code,
+                            'retry_in': RESTART_DELAY
+                        })
+            await asyncio.sleep(RESTART_DELAY)
+
+    def stop(self):
+        self.stopping = True
+        if self.process is not None and self.process.returncode is None:
+            # SIGINT lets discord.py close the connection cleanly
+            self.process.send_signal(signal.SIGINT)
+
+
+async def launch(processes, shard_count):
+    max_concurrency = 1
+    if shard_count is None:
+        shard_count, max_concurrency = await gateway_info(os.getenv('TOKEN'))
+    ranges = shard_ranges(shard_count, processes)
+    log.info('Launching',
+             extra={
+                 'processes': len(ranges),
+                 'shards': shard_count
+             })
+
+    workers = []
+    delay = 0
+    for number, shard_ids in enumerate(ranges):
+        workers.append(Worker(number, shard_ids, shard_count, delay))
+        delay += math.ceil(
+            len(shard_ids) / max_concurrency) * IDENTIFY_INTERVAL
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig,
+                                lambda: [worker.stop() for worker in workers])
+    await asyncio.gather(*(worker.run() for worker in workers))
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the bot as several sharded processes")
+    parser.add_argument('--processes',
+                        type=int,
+                        default=os.cpu_count(),
+                        help="number of bot processes")
+    parser.add_argument('--shards',
+                        type=int,
+                        help="total shard count; the count the shard "
+                        "databases were written with, or else Discord's "
+                        "recommendation, when omitted")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, handlers=[log_handler()])
+    pinned = pinned_shard_count()
+    if pinned is not None:
+        if args.shards not in (None, pinned):
+            parser.error(f"the shard databases were written with {pinned} "
+                         f"shards; resharding isn't supported")
+        args.shards = pinned
+    asyncio.run(launch(args.processes, args.shards))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,174 @@
+# Lean member mode (LEAN_MEMBERS=1): discord.py keeps no member cache and
+# guilds aren't chunked at startup. Each guild instead keeps a compact
+# user_id -> role-flag bitset, filled from storage, and Member objects are
+# fetched only when an edit needs one.
+import bisect
+from array import array
+
+from discord.flags import MemberCacheFlags
+
+from role_index import role_index
+from storage import ROLE_COLUMNS
+
+# Bit of each tracked role within a member's flags byte
+ROLE_BITS = {name: 1 << i for i, name in enumerate(ROLE_COLUMNS)}
+# Members per gateway member query, Discord's maximum
+QUERY_LIMIT = 100
+
+
+def cache_options():
+    # Client options for lean mode
+    return {
+        'member_cache_flags': MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+    }
+
+
+def flags_to_bits(flags):
+    # (has_general, has_singles, has_doubles) -> flags byte
+    return sum(bit for bit, flag in zip(ROLE_BITS.values(), flags) if flag)
+
+
+class GuildBitset:
+    # Sorted user IDs alongside one flags byte each: 9 bytes a member,
+    # where a cached Member with its User costs a few hundred
+
+    __slots__ = ('ids', 'bits')
+
+    def __init__(self, flags=None):
+        # flags is {user_id: bits}
+        ordered = sorted((flags or {}).items())
+        self.ids = array('Q', (user_id for user_id, _ in ordered))
+        self.bits = bytearray(bits for _, bits in ordered)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _index(self, user_id):
+        index = bisect.bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            return index, True
+        return index, False
+
+    def get(self, user_id):
+        index, found = self._index(user_id)
+        return self.bits[index] if found else None
+
+    def set(self, user_id, bits):
+        index, found = self._index(user_id)
+        if found:
+            self.bits[index] = bits
+        else:
+            self.ids.insert(index, user_id)
+            self.bits.insert(index, bits)
+
+    def remove(self, user_id):
+        index, found = self._index(user_id)
+        if found:
+            del self.ids[index]
+            del self.bits[index]
+
+
+class MemberBitsets:
+
+    def __init__(self):
+        # guild_id -> GuildBitset
+        self._guilds = {}
+        # Guilds whose stored flags have been loaded. Member events can
+        # create a guild's bitset before then, so having one isn't enough.
+        self._loaded = set()
+
+    def __len__(self):
+        return sum(len(bitset) for bitset in self._guilds.values())
+
+    def loaded(self, guild_id):
+        return guild_id in self._loaded
+
+    def load(self, guild_id, flags):
+        # flags is {user_id: (username, has_general, has_singles,
+        # has_doubles)}, as produced by member_role_flags. Members already
+        # set by events since startup are newer and keep their bits.
+        bitset = self._guilds.get(guild_id)
+        merged = {
+            user_id: flags_to_bits(state[1:])
+            for user_id, state in flags.items()
+        }
+        if bitset is not None:
+            merged.update(zip(bitset.ids, bitset.bits))
+        self._guilds[guild_id] = GuildBitset(merged)
+        self._loaded.add(guild_id)
+
+    def get(self, guild_id, user_id):
+        bitset = self._guilds.get(guild_id)
+        return bitset.get(user_id) if bitset is not None else None
+
+    def has_role(self, guild_id, user_id, role_name):
+        # True or False, or None for a member or role we don't track
+        bits = self.get(guild_id, user_id)
+        bit = ROLE_BITS.get(role_name)
+        if bits is None or bit is None:
+            return None
+        return bool(bits & bit)
+
+    def set(self, guild_id, user_id, flags):
+        self._guilds.setdefault(guild_id,
+                                GuildBitset()).set(user_id,
+                                                   flags_to_bits(flags))
+
+    def set_role(self, guild_id, user_id, role_name, value):
+        bit = ROLE_BITS.get(role_name)
+        if bit is None:
+            return
+        bitset = self._guilds.setdefault(guild_id, GuildBitset())
+        bits = bitset.get(user_id) or 0
+        bitset.set(user_id, bits | bit if value else bits & ~bit)
+
+    def remove(self, guild_id, user_id):
+        bitset = self._guilds.get(guild_id)
+        if bitset is not None:
+            bitset.remove(user_id)
+
+    def forget(self, guild_id):
+        self._guilds.pop(guild_id, None)
+        self._loaded.discard(guild_id)
+
+
+def raw_member_flags(guild, role_ids):
+    # Flags from the role ID list of a raw member payload, no Member needed
+    return tuple(1 if role is not None and role.id in role_ids else 0
+                 for role in (role_index.get(guild, name)
+                              for name in ROLE_COLUMNS))
+
+
+async def resolve_members(guild, user_ids):
+    # Members for these IDs: cached ones as they are, the rest from gateway
+    # member queries of up to 100 IDs, which cost no REST calls and aren't
+    # added to the cache
+    members = []
+    missing = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id)
+        if member is None:
+            missing.append(user_id)
+        else:
+            members.append(member)
+    for start in range(0, len(missing), QUERY_LIMIT):
+        members += await guild.query_members(
+            user_ids=missing[start:start + QUERY_LIMIT],
+            limit=QUERY_LIMIT,
+            cache=False)
+    return members
+
+
+def dispatch_raw_member_updates(client):
+    # discord.py drops GUILD_MEMBER_UPDATE for uncached members, so member
+    # edits made outside the bot would go unseen; hand the raw payload to an
+    # on_raw_member_update listener as well
+    parsers = client._connection.parsers
+    parse = parsers['GUILD_MEMBER_UPDATE']
+
+    def parse_guild_member_update(data):
+        parse(data)
+        client.dispatch('raw_member_update', data)
+
+    parsers['GUILD_MEMBER_UPDATE'] = parse_guild_member_update
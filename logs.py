@@ -0,0 +1,43 @@
+# Structured (logfmt) logging for the bot and discord.py
+import logging
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="'):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    # ts=... level=... logger=... msg="..." plus one key=value per extra field
+    # and per field given here, which every line carries
+
+    def __init__(self, fields=None):
+        super().__init__()
+        self.fields = fields or {}
+
+    def format(self, record):
+        fields = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            **self.fields,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD and not key.startswith('_'):
+                fields[key] = value
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        return ' '.join(f'{key}={_quote(value)}'
+                        for key, value in fields.items())
+
+
+def log_handler(fields=None):
+    handler = logging.StreamHandler()
+    handler.setFormatter(LogfmtFormatter(fields))
+    return handler
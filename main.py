@@ -4,92 +4,35 @@ import os
 from discord.flags import Intents
 from dotenv import load_dotenv
 from discord.ext import commands
-import sqlite3
-from pymongo.mongo_client import MongoClient
+import asyncio
+import logging
+import tempfile
+import time
+import typing
+import metrics
+from bulk_roles import (BulkRoleJob, MentionedMember, SourceRole,
+                        members_from_csv, members_with_role)
+from database_view import send_database, send_guild_summaries, send_member
+from lean_members import (MemberBitsets, cache_options,
+                          dispatch_raw_member_updates, flags_to_bits,
+                          raw_member_flags, resolve_members)
+from member_sync import member_flags, sync_server_members
+from reaction_buffer import ReactionBuffer
+from reaction_roles import ReactionRoleRegistry
+from role_index import has_role, role_index
+from role_queue import RoleMutationQueue
+from snapshot import export_members
+from storage import ROLE_COLUMNS, CachedStorage, create_storage
+from logs import LogfmtFormatter, log_handler
 
 # Load environment variables first
 load_dotenv()
 
-# MongoDB connection
-mongo_uri = os.getenv('MONGO_URI')
-print(f"MongoDB URI from environment: {mongo_uri}")
-if mongo_uri:
-    # Fix URI format if needed (replace # with ?)
-    if '#' in mongo_uri and '?' not in mongo_uri:
-        mongo_uri = mongo_uri.replace('#', '?')
-        print(f"Fixed MongoDB URI format: {mongo_uri}")
-    
-    # Create a new client and connect to the server without SSL (for Replit compatibility)
-    try:
-        mongo_client = MongoClient(
-            mongo_uri, 
-            ssl=False,
-            serverSelectionTimeoutMS=5000,
-            connectTimeoutMS=5000
-        )
-    except Exception as ssl_error:
-        print(f"SSL connection failed: {ssl_error}")
-        # Fallback: try with basic SSL settings
-        try:
-            mongo_client = MongoClient(
-                mongo_uri, 
-                tls=True,
-                serverSelectionTimeoutMS=5000,
-                connectTimeoutMS=5000
-            )
-        except Exception as fallback_error:
-            print(f"Fallback connection also failed: {fallback_error}")
-            mongo_client = None
-
-    # Send a ping to confirm a successful connection
-    try:
-        mongo_client.admin.command('ping')
-        print("Pinged your deployment. You successfully connected to MongoDB!")
-        mongo_db = mongo_client.get_database(
-        )  # Uses default database from URI
-        mongo_collection = mongo_db.server_members  # Collection name
-    except Exception as e:
-        print(e)
-        mongo_client = None
-        mongo_db = None
-        mongo_collection = None
-else:
-    print("No MongoDB URI found in environment variables")
-    mongo_client = None
-    mongo_db = None
-    mongo_collection = None
-
-# SQLite connection (keeping existing functionality)
-conn = sqlite3.connect('tennis.db')
-cursor = conn.cursor()
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS server_members (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL,
-        has_general_role BOOLEAN DEFAULT 0,
-        has_singles_role BOOLEAN DEFAULT 0,
-        has_doubles_role BOOLEAN DEFAULT 0,
-        UNIQUE(username)
-    )
-''')
-
-# Add new columns to existing table if they don't exist
-try:
-    cursor.execute(
-        'ALTER TABLE server_members ADD COLUMN has_singles_role BOOLEAN DEFAULT 0'
-    )
-except sqlite3.OperationalError:
-    pass  # Column already exists
-
-try:
-    cursor.execute(
-        'ALTER TABLE server_members ADD COLUMN has_doubles_role BOOLEAN DEFAULT 0'
-    )
-except sqlite3.OperationalError:
-    pass  # Column already exists
-
-conn.commit()
+log = logging.getLogger('bot')
+
+# Member storage: SQLite by default, MongoDB with STORAGE_BACKEND=mongo
+db = create_storage()
+reaction_roles = ReactionRoleRegistry(db)
 
 intents = Intents.default()
 # Re-enable privileged intents (ensure they're enabled in Discord Developer Portal)
@@ -97,449 +40,765 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
-client = commands.Bot(command_prefix='$bot ', intents=intents)
+COMMAND_PREFIX = '$bot '
 
 
-@client.event
-async def on_ready():
-    print('We have logged in as {0.user}'.format(client))
+def env_flag(name):
+    # On for 1/true/yes; unset, empty, 0 or anything else leaves it off
+    return (os.getenv(name) or '').strip().lower() in ('1', 'true', 'yes')
 
-    # Sync members for all guilds the bot is in
-    for guild in client.guilds:
-        await sync_server_members(guild)
 
-    # You can set this to your rules channel ID
-    rules_channel_id = int(os.getenv('RULES_CHANNEL_ID', 0))
+# launcher.py sets SHARD_COUNT and SHARD_IDS to give each process its own
+# range of shards; SHARDED=1 runs every shard in this one process instead
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or 0) or None
+SHARD_IDS = [
+    int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',')
+    if shard_id
+] or None
+SHARDED = bool(SHARD_IDS) or env_flag('SHARDED')
 
-    if rules_channel_id:
-        try:
-            rules_channel = client.get_channel(rules_channel_id)
-            if rules_channel:
-                # Check if we already have both messages
-                has_rules_message = False
-                has_singles_doubles_message = False
-
-                async for message in rules_channel.history(limit=100):
-                    if message.author == client.user:
-                        if message.content == "React to this message for your role":
-                            has_rules_message = True
-                        elif message.content == "React with 1️⃣ if you are playing singles or 2️⃣ if you are playing doubles":
-                            has_singles_doubles_message = True
-
-                # Send the rules message if it doesn't exist
-                if not has_rules_message:
-                    await rules_channel.send(
-                        "React to this message for your role")
-                    print(f"Rules message sent to {rules_channel.name}")
-
-                # Send the singles/doubles selection message if it doesn't exist
-                if not has_singles_doubles_message:
-                    message = await rules_channel.send(
-                        "React with 1️⃣ if you are playing singles or 2️⃣ if you are playing doubles"
-                    )
-                    print(
-                        f"Singles/doubles message sent to {rules_channel.name}"
-                    )
-            else:
-                print(f"Could not find channel with ID {rules_channel_id}")
-        except Exception as e:
-            print(f"Error sending rules message: {e}")
+# LEAN_MEMBERS=1 keeps no member cache, only a role-flag bitset per member
+LEAN_MEMBERS = env_flag('LEAN_MEMBERS')
+member_bits = MemberBitsets()
 
+# Seconds allowed for each storage connection attempt, and between retries
+STORAGE_CONNECT_TIMEOUT = 15
+STORAGE_RETRY_DELAY = 30
+# Seconds shutdown waits for buffered reactions and queued role edits
+SHUTDOWN_TIMEOUT = 10
 
-@client.listen('on_message')
-async def handle_message(message):
-    if message.author == client.user:
-        return
-    if message.content.startswith('$bot hello'):
-        await message.channel.send('Hello!')
-    elif message.content.startswith('$bot greet'):
-        await message.channel.send('Hello ' + message.author.name)
-    elif message.content.startswith('$bot database'):
-        try:
-            # First, check for any members in the server who aren't in the database
-            for member in message.guild.members:
-                if not member.bot:  # Skip bots
-                    cursor.execute(
-                        'SELECT * FROM server_members WHERE username = ?',
-                        (member.name, ))
-                    if not cursor.fetchone():
-                        # Member not found in database, add them
-                        general_role = discord.utils.get(message.guild.roles,
-                                                         name="general")
-                        singles_role = discord.utils.get(message.guild.roles,
-                                                         name="singles")
-                        doubles_role = discord.utils.get(message.guild.roles,
-                                                         name="doubles")
-
-                        has_general = general_role in member.roles if general_role else False
-                        has_singles = singles_role in member.roles if singles_role else False
-                        has_doubles = doubles_role in member.roles if doubles_role else False
-
-                        cursor.execute(
-                            '''
-                            INSERT INTO server_members 
-                            (username, has_general_role, has_singles_role, has_doubles_role) 
-                            VALUES (?, ?, ?, ?)
-                        ''',
-                            (member.name, 1 if has_general else 0,
-                             1 if has_singles else 0, 1 if has_doubles else 0))
-                        conn.commit()
-                        print(
-                            f"Added missing member {member.name} to database")
-
-            cursor.execute('SELECT * FROM server_members')
-            rows = cursor.fetchall()
-            if rows:
-                # Create a formatted message
-                response = "**Tennis Database Contents:**\n```"
-                response += "ID | Username | General | Singles | Doubles\n"
-                response += "-" * 80 + "\n"
-
-                for row in rows:
-                    general_text = f"{row[2]} {'(True)' if row[2] == 1 else '(False)'}"
-                    singles_text = f"{row[3]} {'(True)' if row[3] == 1 else '(False)'}" if len(
-                        row) > 3 else "0 (False)"
-                    doubles_text = f"{row[4]} {'(True)' if row[4] == 1 else '(False)'}" if len(
-                        row) > 4 else "0 (False)"
-                    response += f"{row[0]} | {row[1]} | {general_text} | {singles_text} | {doubles_text}\n"
-
-                response += "```"
-                await message.channel.send(response)
-            else:
-                await message.channel.send("The database is empty!")
-        except Exception as e:
-            await message.channel.send(f"Error accessing database: {e}")
-    elif message.content.startswith('$bot promote'):
-        # Check if user has permission to manage roles
-        if not message.author.guild_permissions.manage_roles:
-            await message.channel.send(
-                "You don't have permission to manage roles.")
-            return
+# Set once storage is connected and the reaction-role registry is loaded
+storage_ready = asyncio.Event()
 
-        # Split the command into parts
-        parts = message.content.split()
 
-        # Check if the command has the correct format
-        if len(parts) < 4:
-            await message.channel.send(
-                "Usage: $bot promote [@player] [role_name]")
+async def start_storage():
+    # Connecting and loading the registry are retried together, so a blip
+    # right after connecting can't leave storage_ready unset for good
+    while True:
+        try:
+            if not db.ready:
+                await asyncio.wait_for(db.connect(), STORAGE_CONNECT_TIMEOUT)
+            await reaction_roles.load()
+            break
+        except ValueError:
+            # Misconfigured, e.g. shard databases from another shard count;
+            # retrying won't help
+            log.exception('Cannot start storage')
+            await client.close()
             return
+        except Exception as e:
+            log.warning('Error starting storage: %r', e,
+                        extra={'retry_in': STORAGE_RETRY_DELAY})
+            await asyncio.sleep(STORAGE_RETRY_DELAY)
+    storage_ready.set()
+    log.info('Storage is ready')
 
-        # Get the mentioned user
-        if len(message.mentions) == 0:
-            await message.channel.send("Please mention a user to promote.")
-            return
 
-        target_user = message.mentions[0]
+class TennisBot(commands.AutoShardedBot if SHARDED else commands.Bot):
 
-        # Get the role name by joining all parts after the user mention
-        role_name = ' '.join(parts[3:])
+    storage_task = None
+    metrics_runner = None
 
-        # Find the role in the server
-        role = discord.utils.get(message.guild.roles, name=role_name)
+    async def setup_hook(self):
+        # Storage comes up in the background, so gateway login never waits on
+        # a slow or unreachable database
+        self.storage_task = asyncio.create_task(start_storage())
 
-        if role is None:
-            await message.channel.send(f"Role '{role_name}' not found.")
-            return
+        if LEAN_MEMBERS:
+            dispatch_raw_member_updates(self)
+
+        metrics.instrument_http(self.http)
+        metrics_port = os.getenv('METRICS_PORT')
+        if metrics_port:
+            self.metrics_runner = await metrics.start_server(
+                os.getenv('METRICS_HOST') or '127.0.0.1', int(metrics_port))
 
-        # Check if the user already has the role
-        if role in target_user.roles:
-            await message.channel.send(
-                f"{target_user.display_name} already has the role '{role_name}'."
-            )
+    async def on_message(self, message):
+        # Every message in every channel lands here, so a non-command costs
+        # one prefix comparison; commands are then found by dict lookup
+        if not message.content.startswith(COMMAND_PREFIX):
             return
+        await self.process_commands(message)
 
+    async def close(self):
+        # Ctrl+C, and launcher.py stopping a worker with SIGINT, end up here.
+        # Buffered reactions and queued role edits are applied while the
+        # HTTP session is still open, then the database writes they queued
+        # are flushed as storage closes.
         try:
-            # Add the role to the user
-            await target_user.add_roles(role)
-            await message.channel.send(
-                f"Successfully assigned the role '{role_name}' to {target_user.display_name}!"
-            )
-        except discord.Forbidden:
-            await message.channel.send(
-                "I don't have permission to assign that role.")
-        except discord.HTTPException:
-            await message.channel.send(
-                "An error occurred while assigning the role.")
-
-    elif message.content.startswith('$bot demote'):
-        # Check if user has permission to manage roles
-        if not message.author.guild_permissions.manage_roles:
-            await message.channel.send(
-                "You don't have permission to manage roles.")
-            return
+            await asyncio.wait_for(drain_role_changes(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning('Shutting down with role changes still queued',
+                        extra={
+                            'reactions': reaction_buffer.pending,
+                            'members': role_queue.pending
+                        })
+        # Still connecting (start_storage closes the client itself when
+        # storage is misconfigured)
+        if (self.storage_task is not None
+                and self.storage_task is not asyncio.current_task()):
+            self.storage_task.cancel()
+        try:
+            await db.close()
+        except Exception:
+            log.exception('Error closing storage')
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        await super().close()
+
+
+client_options = {}
+if SHARDED:
+    client_options.update(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+if LEAN_MEMBERS:
+    client_options.update(cache_options())
+client = TennisBot(command_prefix=COMMAND_PREFIX,
+                   intents=intents,
+                   **client_options)
+
+metrics.Gauge('bot_gateway_latency_seconds', 'Gateway latency (s)',
+              lambda: client.latency)
+metrics.Gauge('bot_pending_db_writes', 'Queued database writes',
+              lambda: db.pending_writes)
+metrics.Gauge('bot_pending_role_edits', 'Members with queued role edits',
+              lambda: role_queue.pending)
+metrics.Gauge('bot_cached_members', 'Members in the member cache',
+              lambda: sum(len(guild.members) for guild in client.guilds))
+metrics.Gauge('bot_member_bitsets', 'Members tracked as role bitsets',
+              lambda: len(member_bits))
+if isinstance(db, CachedStorage):
+    metrics.Gauge('bot_member_cache_hits', 'Member cache hits',
+                  lambda: db.cache.hits)
+    metrics.Gauge('bot_member_cache_misses', 'Member cache misses',
+                  lambda: db.cache.misses)
+    metrics.Gauge('bot_member_cache_size', 'Members in the state cache',
+                  lambda: len(db.cache))
 
-        # Split the command into parts
-        parts = message.content.split()
 
-        # Check if the command has the correct format
-        if len(parts) < 4:
-            await message.channel.send(
-                "Usage: $bot demote [@player] [role_name]")
+@client.event
+@metrics.timed('on_ready')
+async def on_ready():
+    log.info('We have logged in as %s', client.user)
+    # After a fresh IDENTIFY discord.py builds new Guild and Role objects,
+    # and role events missed while disconnected never arrive
+    role_index.clear()
+
+    # Member sync and the role messages need storage
+    await storage_ready.wait()
+
+    started = time.perf_counter()
+    if LEAN_MEMBERS:
+        # One guild at a time, so at most one guild's members are in memory
+        for guild in client.guilds:
+            await load_lean_guild(guild)
+    else:
+        # Sync members for all guilds the bot is in, concurrently
+        await asyncio.gather(
+            *(sync_server_members(db, guild) for guild in client.guilds))
+    log.info('Synced guilds',
+             extra={
+                 'guilds': len(client.guilds),
+                 'seconds': round(time.perf_counter() - started, 3)
+             })
+
+    # Older setups name a single rules channel with RULES_CHANNEL_ID; adopt it
+    # for its guild unless that guild already has one
+    legacy_channel = client.get_channel(int(os.getenv('RULES_CHANNEL_ID') or 0))
+    if legacy_channel and not reaction_roles.rules_channel(
+            legacy_channel.guild.id):
+        await reaction_roles.set_rules_channel(legacy_channel.guild.id,
+                                               legacy_channel.id)
+
+    # Make sure every guild's rules channel has both role messages
+    await asyncio.gather(
+        *(ensure_role_messages(guild) for guild in client.guilds))
+
+
+async def load_lean_guild(guild):
+    # Bitsets come from storage, which the raw member events keep current;
+    # Member objects are only fetched (resolve_members) when an edit needs
+    # them. Only a guild that has never been synced is chunked, once and
+    # without caching, to fill storage; rows that member events wrote before
+    # then don't count. Reconnects keep what's loaded.
+    if member_bits.loaded(guild.id):
+        return
+    try:
+        # '' is a stale watermark: synced once, written to since
+        if await db.get_sync_watermark(guild.id) is not None:
+            member_bits.load(guild.id, await db.load_member_flags(guild.id))
             return
+        members = await guild.chunk(cache=False)
+    except Exception:
+        log.exception('Error loading members', extra={'guild': guild.id})
+        return
+    live = await sync_server_members(db, guild, members)
+    if live is not None:
+        member_bits.load(guild.id, live)
+
+
+async def ensure_role_messages(guild):
+    channel_id = reaction_roles.rules_channel(guild.id)
+    if not channel_id:
+        return
+    channel = guild.get_channel(channel_id)
+    if not channel:
+        log.warning('Could not find rules channel',
+                    extra={
+                        'guild': guild.id,
+                        'channel': channel_id
+                    })
+        return
+    try:
+        await reaction_roles.ensure_messages(channel)
+    except Exception:
+        log.exception('Error sending rules message', extra={'guild': guild.id})
 
-        # Get the mentioned user
-        if len(message.mentions) == 0:
-            await message.channel.send("Please mention a user to demote.")
-            return
 
-        target_user = message.mentions[0]
+@client.command()
+async def hello(ctx):
+    await ctx.send('Hello!')
 
-        # Get the role name by joining all parts after the user mention
-        role_name = ' '.join(parts[3:])
 
-        # Find the role in the server
-        role = discord.utils.get(message.guild.roles, name=role_name)
+@client.command()
+async def greet(ctx):
+    await ctx.send('Hello ' + ctx.author.name)
 
-        if role is None:
-            await message.channel.send(f"Role '{role_name}' not found.")
+
+@client.command()
+@commands.guild_only()
+async def database(ctx,
+                   scope: typing.Optional[typing.Literal['all']] = None,
+                   player: typing.Optional[discord.Member] = None):
+    # "all" is matched before the Member converter, so it never costs a
+    # member lookup and can't be taken by a member named "all"
+    try:
+        if not storage_ready.is_set():
+            await ctx.send(
+                "The database is still starting up, try again in a moment.")
+            return
+        # "$bot database all": bot owner's summary of every guild, across
+        # all shards and processes
+        if scope == 'all':
+            if not await client.is_owner(ctx.author):
+                await ctx.send("Only the bot owner can see every guild.")
+                return
+            guild_names = {guild.id: guild.name for guild in client.guilds}
+            await send_guild_summaries(ctx.channel, db, guild_names)
+            return
+        # "$bot database @player": one member's stored roles
+        if player is not None:
+            await send_member(ctx.channel, db, ctx.guild.id, player)
             return
+        # server_members is kept current by the member event listeners;
+        # rows are streamed a page at a time
+        await send_database(ctx.channel, db, ctx.guild.id, ctx.author.id)
+    except Exception as e:
+        await ctx.send(f"Error accessing database: {e}")
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_guild_permissions(manage_guild=True)
+async def setrules(ctx):
+    # Use this channel as the guild's rules channel
+    if not storage_ready.is_set():
+        await ctx.send(
+            "The database is still starting up, try again in a moment.")
+        return
+    try:
+        await reaction_roles.set_rules_channel(ctx.guild.id, ctx.channel.id)
+        await reaction_roles.ensure_messages(ctx.channel)
+    except Exception as e:
+        await ctx.send(f"Error setting up the rules channel: {e}")
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_guild_permissions(manage_guild=True)
+async def stats(ctx):
+    await ctx.send(f"```{metrics.summary()[:1990]}```")
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_guild_permissions(manage_guild=True)
+async def export(ctx, fmt='csv.gz'):
+    # "$bot export [parquet]": this guild's server_members as a file. Rows
+    # are streamed into a temporary file a page at a time.
+    if not storage_ready.is_set():
+        await ctx.send(
+            "The database is still starting up, try again in a moment.")
+        return
+    fmt = 'parquet' if fmt.lower() == 'parquet' else 'csv.gz'
+    try:
+        with tempfile.TemporaryFile() as file:
+            rows = await export_members(db, file, fmt, [ctx.guild.id])
+            size = file.tell()
+            if size > ctx.guild.filesize_limit:
+                await ctx.send(
+                    f"The export is {size // 1024} KiB, over this server's "
+                    f"upload limit; use snapshot.py instead.")
+                return
+            file.seek(0)
+            await ctx.send(f"{rows} members",
+                           file=discord.File(
+                               file, filename=f'members-{ctx.guild.id}.{fmt}'))
+    except Exception as e:
+        await ctx.send(f"Error exporting members: {e}")
+
+
+@setrules.error
+@stats.error
+@export.error
+async def admin_command_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("You don't have permission to manage this server.")
+    elif not isinstance(error, commands.NoPrivateMessage):
+        log.error('Error in command %s: %s', ctx.command.name, error)
+
+
+@client.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+
+@client.after_invoke
+async def record_command_time(ctx):
+    metrics.EVENT_SECONDS.observe(time.perf_counter() - ctx.started,
+                                  event=f'command {ctx.command.name}')
+
 
-        # Check if the user has the role
-        if role not in target_user.roles:
-            await message.channel.send(
-                f"{target_user.display_name} doesn't have the role '{role_name}'."
-            )
+async def bulk_change_role(ctx, targets, source, role, add):
+    # Everyone mentioned, everyone with the source role and everyone listed in
+    # an attached CSV, each edited once
+    verb = "Promoting to" if add else "Demoting from"
+    members = {member.id: member for member in targets}
+    unknown = []
+    if source is not None:
+        source_role = role_index.get(ctx.guild, source)
+        if source_role is None:
+            await ctx.send(f"Role '{source}' not found.")
             return
+        # Lean mode keeps no member lists, only the tracked roles' flags
+        if LEAN_MEMBERS and source_role.name not in ROLE_COLUMNS:
+            await ctx.send(f"from:{source} isn't supported in lean member "
+                           f"mode; only from:{', from:'.join(ROLE_COLUMNS)} "
+                           f"are tracked.")
+            return
+        for member in await members_with_role(ctx.guild, source_role, db):
+            members[member.id] = member
+    for attachment in ctx.message.attachments:
+        if not attachment.filename.lower().endswith('.csv'):
+            continue
+        try:
+            listed, missing = await members_from_csv(ctx.guild, attachment)
+        except ValueError as e:
+            await ctx.send(f"Can't read the CSV: {e}")
+            return
+        unknown += missing
+        for member in listed:
+            members[member.id] = member
+
+    if not members:
+        await ctx.send("No members matched. Mention players, use "
+                       "from:<role> or attach a CSV of players.")
+        return
+
+    job = BulkRoleJob(list(members.values()),
+                      role,
+                      add,
+                      role_queue.guild_limit(ctx.guild.id),
+                      workers=role_queue.per_guild,
+                      reason=f"{ctx.command.name} by {ctx.author}")
+    status = await ctx.send(job.progress(verb))
 
+    async def show_progress(job):
         try:
-            # Remove the role from the user
-            await target_user.remove_roles(role)
-            await message.channel.send(
-                f"Successfully removed the role '{role_name}' from {target_user.display_name}!"
-            )
-        except discord.Forbidden:
-            await message.channel.send(
-                "I don't have permission to remove that role.")
+            await status.edit(content=job.progress(verb))
         except discord.HTTPException:
-            await message.channel.send(
-                "An error occurred while removing the role.")
+            pass
+
+    started = time.perf_counter()
+    await job.run(on_progress=show_progress)
+    log.info('Bulk role change',
+             extra={
+                 'guild': ctx.guild.id,
+                 'role': role.name,
+                 'add': add,
+                 'members': len(job.members),
+                 'changed': job.changed,
+                 'failed': len(job.failed),
+                 'seconds': round(time.perf_counter() - started, 3)
+             })
+    await ctx.send(job.summary("Added" if add else "Removed", unknown))
+
+
+def is_bulk(ctx, targets, source):
+    return (len(targets) != 1 or source is not None
+            or bool(ctx.message.attachments))
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_guild_permissions(manage_roles=True)
+async def promote(ctx,
+                  targets: commands.Greedy[MentionedMember],
+                  source: typing.Optional[SourceRole] = None,
+                  *,
+                  role_name):
+    # Find the role in the server
+    role = role_index.get(ctx.guild, role_name)
+
+    if role is None:
+        await ctx.send(f"Role '{role_name}' not found.")
+        return
+
+    if is_bulk(ctx, targets, source):
+        await bulk_change_role(ctx, targets, source, role, add=True)
+        return
+    target_user = targets[0]
 
+    # Check if the user already has the role
+    if has_role(target_user, role):
+        await ctx.send(
+            f"{target_user.display_name} already has the role '{role_name}'.")
+        return
 
-@client.event
-async def on_raw_reaction_add(payload):
-    # Skip if the reaction is from the bot itself
-    if payload.user_id == client.user.id:
+    try:
+        # Add the role to the user
+        await target_user.add_roles(role)
+        await ctx.send(
+            f"Successfully assigned the role '{role_name}' to {target_user.display_name}!"
+        )
+    except discord.Forbidden:
+        await ctx.send("I don't have permission to assign that role.")
+    except discord.HTTPException:
+        await ctx.send("An error occurred while assigning the role.")
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_guild_permissions(manage_roles=True)
+async def demote(ctx,
+                 targets: commands.Greedy[MentionedMember],
+                 source: typing.Optional[SourceRole] = None,
+                 *,
+                 role_name):
+    # Find the role in the server
+    role = role_index.get(ctx.guild, role_name)
+
+    if role is None:
+        await ctx.send(f"Role '{role_name}' not found.")
         return
 
-    # Get the channel where the reaction was added
-    channel = client.get_channel(payload.channel_id)
+    if is_bulk(ctx, targets, source):
+        await bulk_change_role(ctx, targets, source, role, add=False)
+        return
+    target_user = targets[0]
 
-    if not channel:
+    # Check if the user has the role
+    if not has_role(target_user, role):
+        await ctx.send(
+            f"{target_user.display_name} doesn't have the role '{role_name}'."
+        )
         return
 
-    # Get the message that was reacted to
     try:
-        message = await channel.fetch_message(payload.message_id)
+        # Remove the role from the user
+        await target_user.remove_roles(role)
+        await ctx.send(
+            f"Successfully removed the role '{role_name}' from {target_user.display_name}!"
+        )
+    except discord.Forbidden:
+        await ctx.send("I don't have permission to remove that role.")
+    except discord.HTTPException:
+        await ctx.send("An error occurred while removing the role.")
 
-        # Check if the message is from the bot and has the expected content
-        if message.author.id == client.user.id:
-            guild = client.get_guild(payload.guild_id)
-            if not guild:
-                return
 
-            member = guild.get_member(payload.user_id)
-            if not member:
-                return
+@promote.error
+@demote.error
+async def role_command_error(ctx, error):
+    name = ctx.command.name
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("You don't have permission to manage roles.")
+    elif isinstance(error, commands.MissingRequiredArgument):
+        await ctx.send(f"Usage: $bot {name} [@player ...] [from:role] "
+                       f"[role_name], optionally with a CSV of players")
+    elif not isinstance(error, commands.NoPrivateMessage):
+        log.error('Error in command %s: %s', name, error)
 
-            # Handle general role assignment
-            if message.content == "React to this message for your role":
-                # Check if the reaction is the white_check_mark emoji
-                if str(payload.emoji) == "✅":
-                    # Get the general role
-                    role = discord.utils.get(guild.roles, name="general")
-
-                    # If the role doesn't exist, create it
-                    if not role:
-                        try:
-                            role = await guild.create_role(name="general")
-                            print(f"Created 'general' role")
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to create roles")
-                            return
-                        except Exception as e:
-                            print(f"Error creating role: {e}")
-                            return
-
-                    # Assign the role
-                    if role not in member.roles:
-                        try:
-                            await member.add_roles(role)
-                            print(
-                                f"Assigned 'general' role to {member.display_name}"
-                            )
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to assign roles")
-                        except Exception as e:
-                            print(f"Error assigning role: {e}")
-
-            # Handle singles/doubles role assignment
-            elif message.content == "React with 1️⃣ if you are playing singles or 2️⃣ if you are playing doubles":
-                role_name = None
-
-                if str(payload.emoji) == "1️⃣":
-                    role_name = "singles"
-                elif str(payload.emoji) == "2️⃣":
-                    role_name = "doubles"
-
-                if role_name:
-                    # Get or create the role
-                    role = discord.utils.get(guild.roles, name=role_name)
-
-                    if not role:
-                        try:
-                            role = await guild.create_role(name=role_name)
-                            print(f"Created '{role_name}' role")
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to create roles")
-                            return
-                        except Exception as e:
-                            print(f"Error creating role: {e}")
-                            return
-
-                    # Assign the role
-                    if role not in member.roles:
-                        try:
-                            await member.add_roles(role)
-                            print(
-                                f"Assigned '{role_name}' role to {member.display_name}"
-                            )
-
-                            # Update database
-                            if role_name == "singles":
-                                cursor.execute(
-                                    'UPDATE server_members SET has_singles_role = 1 WHERE username = ?',
-                                    (member.name, ))
-                            elif role_name == "doubles":
-                                cursor.execute(
-                                    'UPDATE server_members SET has_doubles_role = 1 WHERE username = ?',
-                                    (member.name, ))
-                            conn.commit()
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to assign roles")
-                        except Exception as e:
-                            print(f"Error assigning role: {e}")
-    except Exception as e:
-        print(f"Error processing reaction: {e}")
+
+@client.event
+async def on_command_error(ctx, error):
+    # Commands with their own handler have already reported the error
+    if ctx.command and ctx.command.has_error_handler():
+        return
+    # "$bot <anything>" that isn't a command is not an error
+    if isinstance(error, (commands.CommandNotFound, commands.NoPrivateMessage)):
+        return
+    log.error('Error in command %s: %s', ctx.command, error)
 
 
 @client.event
-async def on_raw_reaction_remove(payload):
-    # Skip if the reaction is from the bot itself
-    if payload.user_id == client.user.id:
+@metrics.timed('on_member_join')
+async def on_member_join(member):
+    if member.bot:  # Skip bots
         return
+    flags = member_flags(member)
+    if LEAN_MEMBERS:
+        member_bits.set(member.guild.id, member.id, flags)
+    try:
+        await db.upsert_member(member.guild.id, member.id, member.name, flags)
+    except Exception:
+        log.exception('Error adding member', extra={'guild': member.guild.id})
 
-    # Get the channel where the reaction was removed
-    channel = client.get_channel(payload.channel_id)
 
-    if not channel:
+@client.event
+@metrics.timed('on_member_update')
+async def on_member_update(before, after):
+    if after.bot:  # Skip bots
+        return
+    flags = member_flags(after)
+    if flags == member_flags(before):
         return
+    try:
+        await db.upsert_member(after.guild.id, after.id, after.name, flags)
+    except Exception:
+        log.exception('Error updating member', extra={'guild': after.guild.id})
+
 
-    # Get the message that was reacted to
+@client.event
+@metrics.timed('on_user_update')
+async def on_user_update(before, after):
+    # Keep the stored username current
+    if before.name == after.name or after.bot:
+        return
     try:
-        message = await channel.fetch_message(payload.message_id)
+        await db.rename_member(after.id, after.name)
+    except Exception:
+        log.exception('Error renaming member')
 
-        # Check if the message is from the bot and has the expected content
-        if message.author.id == client.user.id:
-            guild = client.get_guild(payload.guild_id)
-            if not guild:
-                return
 
-            member = guild.get_member(payload.user_id)
-            if not member:
-                return
+@client.event
+@metrics.timed('on_raw_member_update')
+async def on_raw_member_update(data):
+    # Lean mode only: edits to members discord.py doesn't cache. Usernames
+    # aren't tracked here; the next sync picks up renames.
+    guild = client.get_guild(int(data['guild_id']))
+    user = data['user']
+    if guild is None or user.get('bot'):
+        return
+    user_id = int(user['id'])
+    flags = raw_member_flags(guild, {int(role_id) for role_id in data['roles']})
+    # The bot's own edits are already recorded
+    if member_bits.get(guild.id, user_id) == flags_to_bits(flags):
+        return
+    member_bits.set(guild.id, user_id, flags)
+    try:
+        await db.upsert_member(guild.id, user_id, user['username'], flags)
+    except Exception:
+        log.exception('Error updating member', extra={'guild': guild.id})
+
+
+@client.event
+@metrics.timed('on_raw_member_remove')
+async def on_raw_member_remove(payload):
+    # The raw event also fires for members who weren't cached
+    if payload.user.bot:  # Skip bots
+        return
+    member_bits.remove(payload.guild_id, payload.user.id)
+    try:
+        await db.delete_member(payload.guild_id, payload.user.id)
+    except Exception:
+        log.exception('Error removing member',
+                      extra={'guild': payload.guild_id})
+
+
+@client.event
+@metrics.timed('on_guild_role_create')
+async def on_guild_role_create(role):
+    role_index.invalidate(role.guild)
+
+
+@client.event
+@metrics.timed('on_guild_role_update')
+async def on_guild_role_update(before, after):
+    role_index.invalidate(after.guild)
+
+
+@client.event
+@metrics.timed('on_guild_role_delete')
+async def on_guild_role_delete(role):
+    role_index.invalidate(role.guild)
 
-            # Handle general role removal
-            if message.content == "React to this message for your role":
-                # Check if the reaction is the white_check_mark emoji
-                if str(payload.emoji) == "✅":
-                    # Get the general role
-                    role = discord.utils.get(guild.roles, name="general")
-                    if not role:
-                        return
-
-                    # Remove the role
-                    if role in member.roles:
-                        try:
-                            await member.remove_roles(role)
-                            print(
-                                f"Removed 'general' role from {member.display_name}"
-                            )
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to remove roles")
-                        except Exception as e:
-                            print(f"Error removing role: {e}")
-
-            # Handle singles/doubles role removal
-            elif message.content == "React with 1️⃣ if you are playing singles or 2️⃣ if you are playing doubles":
-                role_name = None
-
-                if str(payload.emoji) == "1️⃣":
-                    role_name = "singles"
-                elif str(payload.emoji) == "2️⃣":
-                    role_name = "doubles"
-
-                if role_name:
-                    # Get the role
-                    role = discord.utils.get(guild.roles, name=role_name)
-                    if not role:
-                        return
-
-                    # Remove the role
-                    if role in member.roles:
-                        try:
-                            await member.remove_roles(role)
-                            print(
-                                f"Removed '{role_name}' role from {member.display_name}"
-                            )
-
-                            # Update database
-                            if role_name == "singles":
-                                cursor.execute(
-                                    'UPDATE server_members SET has_singles_role = 0 WHERE username = ?',
-                                    (member.name, ))
-                            elif role_name == "doubles":
-                                cursor.execute(
-                                    'UPDATE server_members SET has_doubles_role = 0 WHERE username = ?',
-                                    (member.name, ))
-                            conn.commit()
-                        except discord.Forbidden:
-                            print(
-                                "Bot doesn't have permission to remove roles")
-                        except Exception as e:
-                            print(f"Error removing role: {e}")
-    except Exception as e:
-        print(f"Error processing reaction removal: {e}")
+
+@client.event
+@metrics.timed('on_guild_available')
+async def on_guild_available(guild):
+    # Rebuilt from a fresh GUILD_CREATE, e.g. after an outage
+    role_index.invalidate(guild)
+
+
+@client.event
+@metrics.timed('on_guild_join')
+async def on_guild_join(guild):
+    role_index.invalidate(guild)
 
 
-async def sync_server_members(guild):
+@client.event
+@metrics.timed('on_guild_remove')
+async def on_guild_remove(guild):
+    role_index.invalidate(guild)
+    member_bits.forget(guild.id)
+
+
+async def record_role_changes(member, added, removed):
+    if LEAN_MEMBERS:
+        for role in added:
+            member_bits.set_role(member.guild.id, member.id, role.name, True)
+        for role in removed:
+            member_bits.set_role(member.guild.id, member.id, role.name, False)
+    # Update database
+    for role in added:
+        await db.set_member_role(member.guild.id, member.id, role.name, True)
+    for role in removed:
+        await db.set_member_role(member.guild.id, member.id, role.name, False)
+
+
+# Reactions arrive already debounced by reaction_buffer, so edits are applied
+# as soon as there's a slot
+role_queue = RoleMutationQueue(on_applied=record_role_changes, delay=0)
+
+
+async def get_or_create_role(guild, role_name):
+    role = role_index.get(guild, role_name)
+    if role:
+        return role
     try:
-        general_role = discord.utils.get(guild.roles, name="general")
-        singles_role = discord.utils.get(guild.roles, name="singles")
-        doubles_role = discord.utils.get(guild.roles, name="doubles")
-
-        for member in guild.members:
-            if not member.bot:  # Skip bots
-                has_general = general_role in member.roles if general_role else False
-                has_singles = singles_role in member.roles if singles_role else False
-                has_doubles = doubles_role in member.roles if doubles_role else False
-
-                cursor.execute(
-                    '''
-                    INSERT OR REPLACE INTO server_members 
-                    (username, has_general_role, has_singles_role, has_doubles_role) 
-                    VALUES (?, ?, ?, ?)
-                ''', (member.name, 1 if has_general else 0,
-                      1 if has_singles else 0, 1 if has_doubles else 0))
-        conn.commit()
-        print(f"Synced {len(guild.members)} members from {guild.name}")
-    except Exception as e:
-        print(f"Error syncing members: {e}")
+        role = await guild.create_role(name=role_name)
+        log.info('Created role', extra={'guild': guild.id, 'role': role_name})
+        return role
+    except discord.Forbidden:
+        log.warning("Bot doesn't have permission to create roles",
+                    extra={'guild': guild.id})
+    except Exception:
+        log.exception('Error creating role', extra={'guild': guild.id})
+    return None
+
+
+async def apply_reaction_batch(batch):
+    # Net role changes from one window of reactions: roles are created and
+    # uncached members looked up once per guild, all guilds at once, and the
+    # edits handed to the role queue. Edits aren't awaited here: the queue
+    # applies them within each guild's own rate limit, so a storm in one
+    # guild never holds up the next window or another guild's reactions.
+    # The database writes they make go through group commit.
+    by_guild = {}
+    for (guild_id, user_id, role_name), (wanted, member) in batch.items():
+        by_guild.setdefault(guild_id, []).append(
+            (user_id, role_name, wanted, member))
+
+    await asyncio.gather(*(queue_guild_reactions(guild_id, changes)
+                           for guild_id, changes in by_guild.items()))
+
+
+async def queue_guild_reactions(guild_id, changes):
+    # Returns the role queue tasks for one guild's changes
+    guild = client.get_guild(guild_id)
+    if not guild:
+        return []
+
+    roles = {}
+    for role_name in {change[1] for change in changes}:
+        # A missing role only needs creating for someone to get it
+        if any(wanted for _, name, wanted, _ in changes if name == role_name):
+            roles[role_name] = await get_or_create_role(guild, role_name)
+        else:
+            roles[role_name] = role_index.get(guild, role_name)
+
+    members = {}
+    missing = []
+    for user_id, role_name, wanted, member in changes:
+        member = member or guild.get_member(user_id)
+        if member:
+            members[user_id] = member
+        # Uncached in lean mode: only look up members the bitset says have
+        # something to remove
+        elif LEAN_MEMBERS and member_bits.has_role(guild_id, user_id,
+                                                   role_name) is not False:
+            missing.append(user_id)
+    for member in await resolve_members(guild, missing):
+        members[member.id] = member
+
+    edits = []
+    for user_id, role_name, wanted, _ in changes:
+        member = members.get(user_id)
+        role = roles[role_name]
+        if not member or not role:
+            continue
+        if wanted:
+            edits.append(role_queue.add(member, role))
+        else:
+            edits.append(role_queue.remove(member, role))
+    return edits
+
+
+reaction_buffer = ReactionBuffer(apply_reaction_batch)
+
+
+async def drain_role_changes():
+    await reaction_buffer.join()
+    await role_queue.join()
+
+metrics.Gauge('bot_pending_reactions', 'Buffered role-message reactions',
+              lambda: reaction_buffer.pending)
+
+
+def role_reaction(payload):
+    # Role name for a reaction on one of our role messages, or None; this
+    # costs no API call, so every other reaction stops here
+    roles = reaction_roles.get(payload.message_id)
+    if roles is None:
+        return None
 
+    # Skip if the reaction is from the bot itself
+    if payload.user_id == client.user.id:
+        return None
 
-client.run(os.getenv('TOKEN'))
+    return roles.get(str(payload.emoji))
+
+
+@client.event
+@metrics.timed('on_raw_reaction_add')
+async def on_raw_reaction_add(payload):
+    role_name = role_reaction(payload)
+    if role_name:
+        reaction_buffer.add(payload.guild_id, payload.user_id, role_name,
+                            True, payload.member)
+
+
+@client.event
+@metrics.timed('on_raw_reaction_remove')
+async def on_raw_reaction_remove(payload):
+    role_name = role_reaction(payload)
+    if role_name:
+        reaction_buffer.add(payload.guild_id, payload.user_id, role_name,
+                            False)
+
+
+def main():
+    # Every log line says which shards it came from when there are several
+    # processes
+    fields = {'shards': os.getenv('SHARD_IDS')} if SHARD_IDS else None
+    # discord.py sets its own formatter on the handler unless given one
+    client.run(os.getenv('TOKEN'),
+               log_handler=log_handler(fields),
+               log_formatter=LogfmtFormatter(fields),
+               root_logger=True)
+
+
+# Importing this module (e.g. from benchmark.py) sets everything up without
+# connecting to Discord
+if __name__ == '__main__':
+    main()
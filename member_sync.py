@@ -0,0 +1,98 @@
+# Incremental, diff-based member sync
+import logging
+import time
+import zlib
+
+from role_index import has_role, role_index
+
+log = logging.getLogger(__name__)
+
+
+def member_flags(member):
+    # (has_general, has_singles, has_doubles) for a single member
+    guild = member.guild
+    general_role = role_index.get(guild, "general")
+    singles_role = role_index.get(guild, "singles")
+    doubles_role = role_index.get(guild, "doubles")
+    return _flags(member, general_role, singles_role, doubles_role)
+
+
+def member_role_flags(guild, members=None):
+    # {user_id: (username, has_general, has_singles, has_doubles)} from the
+    # live cache, or from members fetched without caching them
+    general_role = role_index.get(guild, "general")
+    singles_role = role_index.get(guild, "singles")
+    doubles_role = role_index.get(guild, "doubles")
+
+    flags = {}
+    for member in guild.members if members is None else members:
+        if not member.bot:  # Skip bots
+            flags[member.id] = (member.name,
+                                *_flags(member, general_role, singles_role,
+                                        doubles_role))
+    return flags
+
+
+def _flags(member, general_role, singles_role, doubles_role):
+    return (1 if has_role(member, general_role) else 0,
+            1 if has_role(member, singles_role) else 0,
+            1 if has_role(member, doubles_role) else 0)
+
+
+def flags_fingerprint(flags):
+    # Order-independent digest of a guild's member state. crc32 is stable
+    # across processes (unlike hash()), so it can be persisted as a watermark.
+    total = 0
+    for user_id, (username, general, singles, doubles) in flags.items():
+        total += zlib.crc32(
+            f"{user_id}\0{username}\0{general}{singles}{doubles}".encode())
+    return f"{len(flags)}:{total & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def diff_member_flags(stored, live):
+    # Rows to insert (new members), rows to update (changed username or
+    # flags) and user IDs to delete (members who left)
+    inserts = []
+    updates = []
+    for user_id, state in live.items():
+        current = stored.get(user_id)
+        if current is None:
+            inserts.append((user_id, *state))
+        elif current != state:
+            updates.append((*state, user_id))
+    deletes = [user_id for user_id in stored if user_id not in live]
+    return inserts, updates, deletes
+
+
+async def sync_server_members(db, guild, members=None):
+    # Returns the live member state, or None if the sync failed
+    try:
+        started = time.perf_counter()
+        live = member_role_flags(guild, members)
+        fingerprint = flags_fingerprint(live)
+
+        # Nothing changed since the last sync of this guild
+        if await db.get_sync_watermark(guild.id) == fingerprint:
+            log.info('Skipped member sync, no changes',
+                     extra={'guild': guild.id})
+            return live
+
+        stored = await db.load_member_flags(guild.id)
+        inserts, updates, deletes = diff_member_flags(stored, live)
+        await db.apply_member_diff(guild.id, fingerprint, inserts, updates,
+                                   deletes)
+        elapsed = time.perf_counter() - started
+        rate = len(live) / elapsed if elapsed > 0 else 0
+        log.info('Synced members',
+                 extra={
+                     'guild': guild.id,
+                     'members': len(live),
+                     'seconds': round(elapsed, 3),
+                     'rows_per_s': round(rate),
+                     'inserted': len(inserts),
+                     'updated': len(updates),
+                     'deleted': len(deletes),
+                 })
+        return live
+    except Exception:
+        log.exception('Error syncing members', extra={'guild': guild.id})
@@ -0,0 +1,212 @@
+# In-process metrics with a Prometheus text endpoint
+import bisect
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0)
+
+_metrics = []
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{_label_text(self.labels, key)} {value}'
+
+
+class Gauge:
+    # Read from a callback at scrape time, so nothing has to keep it updated
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        _metrics.append(self)
+
+    def value(self):
+        try:
+            return self.callback()
+        except Exception:
+            return float('nan')
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {self.value()}'
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        entry[1] += seconds
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, key, q):
+        # Upper bound of the bucket holding the q-th observation
+        buckets, _, count = self.values[key]
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS + (float('inf'), ), buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, (buckets, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf', ), buckets):
+                cumulative += bucket_count
+                labels = _label_text(self.labels, key, [('le', bound)])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _label_text(self.labels, key)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+EVENT_SECONDS = Histogram('bot_event_seconds',
+                          'Event handler and command latency',
+                          ('event', ))
+API_CALLS = Counter('bot_discord_api_calls_total', 'Discord API calls',
+                    ('route', 'status'))
+API_SECONDS = Histogram('bot_discord_api_seconds', 'Discord API call latency',
+                        ('route', ))
+DB_SECONDS = Histogram('bot_db_seconds', 'Database operation latency',
+                       ('op', ))
+
+
+def timed(event):
+    # Wrap an event handler so each call lands in EVENT_SECONDS
+    def decorator(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with EVENT_SECONDS.time(event=event):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_http(http):
+    # Count and time every REST call made through discord.py's HTTP client
+    request = http.request
+
+    async def counted_request(route, **kwargs):
+        name = f'{route.method} {route.path}'
+        status = 'ok'
+        started = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, 'status', 'error'))
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, route=name)
+            API_CALLS.inc(route=name, status=status)
+
+    http.request = counted_request
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def start_server(host, port):
+    # Serve /metrics in Prometheus text format on the bot's event loop
+
+    async def handle(request):
+        return web.Response(text=render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info('Serving metrics', extra={'host': host, 'port': port})
+    return runner
+
+
+def summary():
+    # Short human-readable digest for `$bot stats`
+    lines = []
+    for metric in _metrics:
+        if isinstance(metric, Gauge):
+            lines.append(f"{metric.help}: {metric.value():.3f}")
+
+    lines.append("Events (count, p50, p99):")
+    for key in sorted(EVENT_SECONDS.values):
+        count = EVENT_SECONDS.values[key][2]
+        lines.append(f"  {key[0]}: {count}, "
+                     f"{EVENT_SECONDS.quantile(key, 0.5) * 1000:g}ms, "
+                     f"{EVENT_SECONDS.quantile(key, 0.99) * 1000:g}ms")
+
+    calls = {}
+    for (route, _), count in API_CALLS.values.items():
+        calls[route] = calls.get(route, 0) + count
+    lines.append(f"Discord API calls: {sum(calls.values())}")
+    for route, count in sorted(calls.items(), key=lambda item: -item[1])[:5]:
+        lines.append(f"  {route}: {count}")
+
+    lines.append("Database (count, avg):")
+    for key, (_, total, count) in sorted(DB_SECONDS.values.items()):
+        lines.append(f"  {key[0]}: {count}, {total / count * 1000:.2f}ms")
+    return '\n'.join(lines)
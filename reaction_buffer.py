@@ -0,0 +1,58 @@
+# Debounced ingestion of role-message reactions. Reaction handlers only
+# record the latest wanted state per (guild, user, role); a single consumer
+# hands the net changes over in batches.
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ReactionBuffer:
+
+    def __init__(self, process, window=0.5, max_batch=500):
+        # Awaited as process(batch) with batch being
+        # {(guild_id, user_id, role_name): (wanted, member or None)}
+        self.process = process
+        # Seconds events are collected before a batch is processed; a batch
+        # waiting on a full buffer is started early
+        self.window = window
+        self.max_batch = max_batch
+        self._events = {}
+        self._full = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self):
+        return len(self._events)
+
+    def add(self, guild_id, user_id, role_name, wanted, member=None):
+        # An add followed by a remove (or the reverse) leaves only the last
+        key = (guild_id, user_id, role_name)
+        self._events.pop(key, None)
+        self._events[key] = (wanted, member)
+        if len(self._events) >= self.max_batch:
+            self._full.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def join(self):
+        # Wait until every buffered event has been processed
+        while self._task is not None:
+            await asyncio.wait([self._task])
+
+    async def _run(self):
+        # Batches run one after another, so events arriving while one is
+        # being applied keep coalescing into the next
+        while self._events:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            batch, self._events = self._events, {}
+            try:
+                await self.process(batch)
+            except Exception:
+                log.exception('Error processing reactions',
+                              extra={'events': len(batch)})
+        self._task = None
@@ -0,0 +1,118 @@
+# Registry of the bot's role messages, keyed by message ID
+import logging
+
+import discord
+
+RULES_MESSAGE = "React to this message for your role"
+SINGLES_DOUBLES_MESSAGE = "React with 1️⃣ if you are playing singles or 2️⃣ if you are playing doubles"
+
+# kind -> (message content, emoji -> role name table) for each role message
+ROLE_MESSAGES = {
+    'rules': (RULES_MESSAGE, {
+        "✅": "general"
+    }),
+    'singles_doubles': (SINGLES_DOUBLES_MESSAGE, {
+        "1️⃣": "singles",
+        "2️⃣": "doubles"
+    }),
+}
+
+# Messages searched when adopting role messages posted before their IDs
+# were stored
+HISTORY_LIMIT = 100
+
+log = logging.getLogger(__name__)
+
+
+class ReactionRoleRegistry:
+
+    def __init__(self, db):
+        self._db = db
+        # message_id -> {emoji: role_name}
+        self._messages = {}
+        # guild_id -> {kind: (channel_id, message_id)}
+        self._guild_messages = {}
+        # guild_id -> rules channel_id
+        self._rules_channels = {}
+
+    async def load(self):
+        self._messages = {}
+        self._guild_messages = {}
+        for (message_id, kind, guild_id, channel_id, emoji,
+             role_name) in await self._db.load_reaction_roles():
+            self._messages.setdefault(message_id, {})[emoji] = role_name
+            self._guild_messages.setdefault(guild_id,
+                                            {})[kind] = (channel_id,
+                                                         message_id)
+        self._rules_channels = await self._db.load_rules_channels()
+        log.info('Loaded reaction-role messages',
+                 extra={'messages': len(self._messages)})
+
+    def get(self, message_id):
+        # Emoji table for a role message, or None for any other message
+        return self._messages.get(message_id)
+
+    def rules_channel(self, guild_id):
+        return self._rules_channels.get(guild_id)
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        await self._db.set_rules_channel(guild_id, channel_id)
+        self._rules_channels[guild_id] = channel_id
+
+    async def register(self, message, kind):
+        roles = ROLE_MESSAGES[kind][1]
+        # Persist first so a crash can't leave the registry ahead of the db
+        await self._db.save_reaction_roles(message.guild.id,
+                                           message.channel.id, message.id,
+                                           kind, roles)
+        # A guild has one message of each kind; forget the one it replaces
+        guild_messages = self._guild_messages.setdefault(message.guild.id, {})
+        previous = guild_messages.get(kind)
+        if previous:
+            self._messages.pop(previous[1], None)
+        guild_messages[kind] = (message.channel.id, message.id)
+        self._messages[message.id] = dict(roles)
+
+    async def adopt_messages(self, channel):
+        # One-time, bounded history lookup for role messages the bot posted
+        # before their IDs were stored (e.g. by an older release), so they
+        # keep working instead of being posted again
+        kinds = {content: kind for kind, (content, _) in ROLE_MESSAGES.items()}
+        async for message in channel.history(limit=HISTORY_LIMIT):
+            if message.author.id != channel.guild.me.id:
+                continue
+            # History is newest first, so the latest copy of each wins
+            kind = kinds.pop(message.content, None)
+            if kind is not None:
+                await self.register(message, kind)
+                log.info('Adopted role message',
+                         extra={
+                             'guild': channel.guild.id,
+                             'channel': channel.id,
+                             'kind': kind
+                         })
+            if not kinds:
+                break
+
+    async def ensure_messages(self, channel):
+        # Check each stored role message with one fetch and only post the
+        # ones that are missing, instead of scanning the channel history
+        if not self._guild_messages.get(channel.guild.id):
+            await self.adopt_messages(channel)
+        guild_messages = self._guild_messages.get(channel.guild.id, {})
+        for kind, (content, roles) in ROLE_MESSAGES.items():
+            stored = guild_messages.get(kind)
+            if stored and stored[0] == channel.id:
+                try:
+                    await channel.fetch_message(stored[1])
+                    continue
+                except discord.NotFound:
+                    pass
+            message = await channel.send(content)
+            await self.register(message, kind)
+            log.info('Sent role message',
+                     extra={
+                         'guild': channel.guild.id,
+                         'channel': channel.id,
+                         'kind': kind
+                     })
@@ -0,0 +1,39 @@
+# Per-guild role lookup tables, rebuilt lazily after role events
+class RoleIndex:
+
+    def __init__(self):
+        # guild_id -> ({name: Role}, {role_id: Role})
+        self._guilds = {}
+
+    def _tables(self, guild):
+        tables = self._guilds.get(guild.id)
+        if tables is None:
+            by_name = {}
+            by_id = {}
+            for role in guild.roles:
+                # First match wins, like discord.utils.get(guild.roles, name=...)
+                by_name.setdefault(role.name, role)
+                by_id[role.id] = role
+            tables = self._guilds[guild.id] = (by_name, by_id)
+        return tables
+
+    def get(self, guild, name):
+        return self._tables(guild)[0].get(name)
+
+    def get_by_id(self, guild, role_id):
+        return self._tables(guild)[1].get(role_id)
+
+    def invalidate(self, guild):
+        self._guilds.pop(guild.id, None)
+
+    def clear(self):
+        self._guilds.clear()
+
+
+def has_role(member, role):
+    # Looks the role ID up in the member's sorted role-ID array instead of
+    # building and scanning the member.roles list
+    return role is not None and member.get_role(role.id) is not None
+
+
+role_index = RoleIndex()
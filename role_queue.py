@@ -0,0 +1,137 @@
+# Per-member queue of role changes, coalesced into as few API calls as possible
+import asyncio
+import logging
+
+import discord
+
+from role_index import has_role
+
+log = logging.getLogger(__name__)
+
+
+class RoleMutationQueue:
+
+    def __init__(self, on_applied=None, delay=0.5, per_guild=2):
+        # Awaited as on_applied(member, added, removed) after a successful edit
+        self.on_applied = on_applied
+        # Seconds to collect changes for a member before applying them
+        self.delay = delay
+        # Member edits share a per-guild rate-limit bucket, so only a few run
+        # at once per guild; discord.py still handles any 429 that slips by
+        self.per_guild = per_guild
+        # (guild_id, member_id) -> {role_id: (role, wanted)} not yet applied
+        self._pending = {}
+        # (guild_id, member_id) -> latest Member seen, for members that
+        # aren't in the member cache
+        self._members = {}
+        # (guild_id, member_id) -> latest task applying that member's changes
+        self._running = {}
+        self._guild_limits = {}
+
+    @property
+    def pending(self):
+        # Members with role changes waiting to be applied
+        return len(self._pending)
+
+    # add and remove return the task that will apply the change
+
+    def add(self, member, role):
+        return self._mutate(member, role, True)
+
+    def remove(self, member, role):
+        return self._mutate(member, role, False)
+
+    def guild_limit(self, guild_id):
+        # Semaphore every role edit in the guild goes through, bulk ones too
+        limit = self._guild_limits.get(guild_id)
+        if limit is None:
+            limit = self._guild_limits[guild_id] = asyncio.Semaphore(
+                self.per_guild)
+        return limit
+
+    async def join(self):
+        # Wait until every queued change has been applied
+        while self._running:
+            await asyncio.wait(list(self._running.values()))
+
+    def _mutate(self, member, role, wanted):
+        key = (member.guild.id, member.id)
+        changes = self._pending.get(key)
+        if changes is None:
+            changes = self._pending[key] = {}
+            previous = self._running.get(key)
+            self._running[key] = asyncio.create_task(
+                self._apply_later(member.guild, member.id, previous))
+        # The latest request for a role wins
+        changes[role.id] = (role, wanted)
+        self._members[key] = member
+        return self._running[key]
+
+    async def _apply_later(self, guild, member_id, previous):
+        key = (guild.id, member_id)
+        try:
+            await asyncio.sleep(self.delay)
+            # Never run two edits for the same member at once
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self.guild_limit(guild.id):
+                # Changes keep coalescing while we wait for a slot
+                changes = self._pending.pop(key)
+                member = self._members.pop(key)
+                await self._apply(guild, member_id, member, changes)
+        except Exception:
+            log.exception('Error applying role changes',
+                          extra={'guild': guild.id, 'member': member_id})
+        finally:
+            if self._running.get(key) is asyncio.current_task():
+                del self._running[key]
+
+    async def _apply(self, guild, member_id, member, changes):
+        # The cached member has the freshest roles
+        member = guild.get_member(member_id) or member
+
+        added = [
+            role for role, wanted in changes.values()
+            if wanted and not has_role(member, role)
+        ]
+        removed = [
+            role for role, wanted in changes.values()
+            if not wanted and has_role(member, role)
+        ]
+        # Net-zero toggles cost nothing
+        if not added and not removed:
+            return
+
+        try:
+            if len(added) + len(removed) == 1:
+                # The per-role endpoints can't clobber a concurrent edit
+                if added:
+                    await member.add_roles(*added)
+                else:
+                    await member.remove_roles(*removed)
+            else:
+                # Several changes become one edit of the full role list
+                removed_ids = {role.id for role in removed}
+                roles = [
+                    role for role in member.roles
+                    if not role.is_default() and role.id not in removed_ids
+                ]
+                await member.edit(roles=roles + added)
+        except discord.Forbidden:
+            log.warning("Bot doesn't have permission to edit roles",
+                        extra={'guild': guild.id})
+            return
+        except discord.HTTPException as e:
+            log.error('Error editing roles: %s', e, extra={'guild': guild.id})
+            return
+
+        log.info('Edited roles',
+                 extra={
+                     'guild': guild.id,
+                     'member': member.id,
+                     'added': ','.join(role.name for role in added),
+                     'removed': ','.join(role.name for role in removed),
+                 })
+
+        if self.on_applied:
+            await self.on_applied(member, added, removed)
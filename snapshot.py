@@ -0,0 +1,247 @@
+# Snapshots of server_members as Parquet or gzipped CSV, streamed a page at a
+# time in both directions.
+#
+#   python snapshot.py export members.parquet [--guild ID]
+#   python snapshot.py import members.csv.gz [--guild ID]
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from logs import log_handler
+from member_sync import diff_member_flags, flags_fingerprint
+from storage import create_storage
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ('guild_id', 'user_id', 'username', 'has_general_role',
+           'has_singles_role', 'has_doubles_role')
+# Rows read from storage, written as one Parquet row group, or read back at
+# a time
+PAGE_ROWS = 10000
+FORMATS = ('parquet', 'csv.gz')
+
+
+def snapshot_format(name):
+    for fmt in FORMATS:
+        if name.lower().endswith(f'.{fmt}'):
+            return fmt
+    raise ValueError(f"{name} should end in .parquet or .csv.gz")
+
+
+def _pyarrow():
+    # Imported here so pyarrow is only needed for Parquet
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet snapshots need pyarrow installed "
+                         "(pip install pyarrow)") from None
+    return pyarrow
+
+
+class CsvWriter:
+
+    def __init__(self, file):
+        self.gzip = gzip.GzipFile(fileobj=file, mode='wb')
+        self.text = io.TextIOWrapper(self.gzip, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        self.gzip.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, file):
+        pa = _pyarrow()
+        self.pa = pa
+        self.schema = pa.schema([
+            ('guild_id', pa.int64()),
+            ('user_id', pa.int64()),
+            ('username', pa.string()),
+            ('has_general_role', pa.int8()),
+            ('has_singles_role', pa.int8()),
+            ('has_doubles_role', pa.int8()),
+        ])
+        self.writer = pa.parquet.ParquetWriter(file,
+                                               self.schema,
+                                               compression='zstd')
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(
+            self.pa.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def read_rows(file, fmt):
+    # Batches of row tuples in COLUMNS order
+    if fmt == 'parquet':
+        pa = _pyarrow()
+        parquet = pa.parquet.ParquetFile(file)
+        for batch in parquet.iter_batches(batch_size=PAGE_ROWS,
+                                          columns=list(COLUMNS)):
+            yield list(zip(*(batch.column(name).to_pylist()
+                             for name in COLUMNS)))
+        return
+
+    with gzip.open(file, 'rt', encoding='utf-8', newline='') as text:
+        reader = csv.reader(text)
+        header = tuple(next(reader, ()))
+        if header != COLUMNS:
+            raise ValueError(f"Expected CSV columns {','.join(COLUMNS)}")
+        batch = []
+        for guild_id, user_id, username, *flags in reader:
+            batch.append((int(guild_id), int(user_id), username,
+                          *map(int, flags)))
+            if len(batch) == PAGE_ROWS:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+async def export_members(db, file, fmt, guild_ids):
+    # Streams each guild's members in user ID order; only one page is ever
+    # held in memory. Returns the number of rows written.
+    writer = ParquetWriter(file) if fmt == 'parquet' else CsvWriter(file)
+    written = 0
+    try:
+        for guild_id in guild_ids:
+            after_id = 0
+            while True:
+                rows = await db.fetch_member_rows(guild_id, after_id,
+                                                  PAGE_ROWS)
+                if not rows:
+                    break
+                writer.write([(guild_id, *row) for row in rows])
+                written += len(rows)
+                after_id = rows[-1][0]
+    finally:
+        writer.close()
+    return written
+
+
+def check_grouped(file, fmt, guild_id=None):
+    # Each guild's rows (or just guild_id's) must be one run, since a guild
+    # is restored as soon as its run ends. Only guild IDs are kept.
+    seen = set()
+    current = None
+    for batch in read_rows(file, fmt):
+        for row_guild, *_ in batch:
+            if guild_id is not None and row_guild != guild_id:
+                continue
+            if row_guild != current:
+                if row_guild in seen:
+                    raise ValueError("Snapshot rows must be grouped by guild")
+                seen.add(row_guild)
+                current = row_guild
+
+
+async def import_members(db, file, fmt, guild_id=None):
+    # Restores each guild in the snapshot (or just guild_id) to exactly the
+    # snapshot's rows, through the same diff as a member sync. The snapshot's
+    # fingerprint becomes the sync watermark, so the next sync only writes
+    # what changed since. Returns {guild_id: rows changed}.
+    #
+    # The file is read twice: a bad snapshot is refused before any guild
+    # has been written.
+    start = file.tell() if hasattr(file, 'seek') else None
+    check_grouped(file, fmt, guild_id)
+    if start is not None:
+        file.seek(start)
+
+    changed = {}
+    current = None
+    members = {}
+
+    async def restore():
+        stored = await db.load_member_flags(current)
+        inserts, updates, deletes = diff_member_flags(stored, members)
+        changed[current] = await db.apply_member_diff(
+            current, flags_fingerprint(members), inserts, updates, deletes)
+
+    for batch in read_rows(file, fmt):
+        for row_guild, user_id, username, *flags in batch:
+            if guild_id is not None and row_guild != guild_id:
+                continue
+            if row_guild != current:
+                if current is not None:
+                    await restore()
+                current = row_guild
+                members = {}
+            members[user_id] = (username, *flags)
+    if current is not None:
+        await restore()
+    return changed
+
+
+async def run_command(args):
+    db = create_storage()
+    await db.connect()
+    try:
+        fmt = snapshot_format(args.path)
+        if fmt == 'parquet':
+            # Fail before an empty export file is created
+            _pyarrow()
+        if args.command == 'export':
+            if args.guild:
+                guild_ids = [args.guild]
+            else:
+                guild_ids = sorted(row[0] for row in await db.guild_summaries())
+            with open(args.path, 'wb') as file:
+                written = await export_members(db, file, fmt, guild_ids)
+            log.info('Exported members',
+                     extra={
+                         'path': args.path,
+                         'guilds': len(guild_ids),
+                         'rows': written
+                     })
+        else:
+            changed = await import_members(db, args.path, fmt, args.guild)
+            log.info('Imported members',
+                     extra={
+                         'path': args.path,
+                         'guilds': len(changed),
+                         'changed': sum(changed.values())
+                     })
+    finally:
+        await db.close()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export or import server_members snapshots")
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('path', help="a .parquet or .csv.gz file")
+    parser.add_argument('--guild',
+                        type=int,
+                        help="only this guild; every guild by default")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    # With SHARD_COUNT set, work across every shard's database file. Run
+    # this while the bot is stopped so each file still has one writer.
+    shard_count = os.getenv('SHARD_COUNT')
+    if shard_count and not os.getenv('SHARD_IDS'):
+        os.environ['SHARD_IDS'] = ','.join(map(str, range(int(shard_count))))
+    logging.basicConfig(level=logging.INFO, handlers=[log_handler()])
+    asyncio.run(run_command(args))
+
+
+if __name__ == '__main__':
+    run()
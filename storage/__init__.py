@@ -0,0 +1,47 @@
+# Pluggable member storage; the backend is chosen with STORAGE_BACKEND
+import os
+
+from .base import ROLE_COLUMNS, Storage
+from .cache import CachedStorage
+from .sharded import ShardedStorage, shard_for, shard_path, stored_shard_count
+from .sqlite import SQLiteStorage
+
+
+def create_storage():
+    storage = _create_backend()
+    # Recently used member state is kept in memory in front of the backend;
+    # MEMBER_CACHE_SIZE=0 turns that off
+    size = int(os.getenv('MEMBER_CACHE_SIZE') or 10000)
+    if size > 0:
+        ttl = float(os.getenv('MEMBER_CACHE_TTL') or 300)
+        storage = CachedStorage(storage, size, ttl)
+    return storage
+
+
+def _create_backend():
+    backend = (os.getenv('STORAGE_BACKEND') or 'sqlite').lower()
+    if backend == 'sqlite':
+        path = os.getenv('SQLITE_PATH') or 'tennis.db'
+        # launcher.py gives each process a range of shards; SQLite then keeps
+        # one file per shard so the processes never share a writer
+        shard_ids = os.getenv('SHARD_IDS')
+        if shard_ids:
+            return ShardedStorage(
+                path, int(os.getenv('SHARD_COUNT')),
+                [int(shard_id) for shard_id in shard_ids.split(',')])
+        return SQLiteStorage(path)
+    if backend == 'mongo':
+        mongo_uri = os.getenv('MONGO_URI')
+        if not mongo_uri:
+            raise ValueError("STORAGE_BACKEND=mongo needs MONGO_URI to be set")
+        # Imported here so pymongo is only needed when Mongo is used
+        from .mongo import MongoStorage
+        return MongoStorage(mongo_uri)
+    raise ValueError(f"Unknown STORAGE_BACKEND '{backend}'")
+
+
+__all__ = [
+    'CachedStorage', 'ROLE_COLUMNS', 'SQLiteStorage', 'ShardedStorage',
+    'Storage', 'create_storage', 'shard_for', 'shard_path',
+    'stored_shard_count'
+]
@@ -0,0 +1,183 @@
+# Interface shared by the storage backends
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+# Role name -> member field holding its flag
+ROLE_COLUMNS = {
+    "general": "has_general_role",
+    "singles": "has_singles_role",
+    "doubles": "has_doubles_role",
+}
+
+log = logging.getLogger(__name__)
+
+
+class Storage:
+    # Member rows are (id, username, has_general, has_singles, has_doubles)
+    # where id is a per-guild keyset cursor, and member state is
+    # (username, has_general, has_singles, has_doubles) keyed by user ID.
+
+    def __init__(self, flush_interval=0.05, flush_ops=100):
+        # Group commit: single-member writes are queued and written together
+        # every flush_interval seconds or every flush_ops writes
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        self._pending = []
+        self._flush_task = None
+        # False until connect() succeeds; writes queued before then are held
+        # and written once the backend is up
+        self.ready = False
+        # Open batch() blocks; while any is open writes wait for its end
+        self._batches = 0
+        # A member write makes the guild's sync watermark stale: the stored
+        # state no longer matches the fingerprint of the last sync. The next
+        # flush clears the watermarks of these guilds, and of every guild a
+        # renamed user is in, in the same batch as the writes. A cleared
+        # watermark is '' rather than gone, so it still records that the
+        # guild's members were stored by a full sync once.
+        self._stale_guilds = set()
+        self._stale_users = set()
+        # Guilds whose watermark is already cleared until their next sync
+        self._cleared_guilds = set()
+
+    @property
+    def pending_writes(self):
+        return len(self._pending)
+
+    @asynccontextmanager
+    async def batch(self):
+        # Writes queued inside the block are committed together when it ends
+        self._batches += 1
+        try:
+            yield
+        finally:
+            self._batches -= 1
+            await self.flush()
+
+    def _invalidate_watermark(self, guild_id):
+        if guild_id not in self._cleared_guilds:
+            self._cleared_guilds.add(guild_id)
+            self._stale_guilds.add(guild_id)
+
+    def _invalidate_user_watermarks(self, user_id):
+        self._stale_users.add(user_id)
+
+    def _watermark_written(self, guild_id):
+        # Called before a sync writes a new fingerprint, so member writes
+        # racing with it clear it again
+        self._cleared_guilds.discard(guild_id)
+
+    async def _queue(self, op):
+        self._pending.append(op)
+        if not self.ready or self._batches:
+            return
+        if len(self._pending) >= self.flush_ops:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(
+                self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('Error flushing database writes')
+
+    async def flush(self):
+        # Write every queued op in one batch, in queue order
+        if not self.ready or not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        guilds, self._stale_guilds = self._stale_guilds, set()
+        users, self._stale_users = self._stale_users, set()
+        await self._write_batch(pending, guilds, users)
+
+    async def _write_batch(self, ops, stale_guilds, stale_users):
+        # Clear the watermarks of stale_guilds and of every guild a user in
+        # stale_users is in, then write ops
+        raise NotImplementedError
+
+    async def connect(self):
+        await self._connect()
+        self.ready = True
+        await self.flush()
+
+    async def _connect(self):
+        # Open the backend and bring its schema/indexes up to date
+        raise NotImplementedError
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def load_member_flags(self, guild_id):
+        # {user_id: (username, has_general, has_singles, has_doubles)}
+        raise NotImplementedError
+
+    async def get_member_state(self, guild_id, user_id):
+        # (username, has_general, has_singles, has_doubles), or None
+        raise NotImplementedError
+
+    async def upsert_member(self, guild_id, user_id, username, flags):
+        raise NotImplementedError
+
+    async def rename_member(self, user_id, username):
+        raise NotImplementedError
+
+    async def delete_member(self, guild_id, user_id):
+        raise NotImplementedError
+
+    async def set_member_role(self, guild_id, user_id, role_name, value):
+        raise NotImplementedError
+
+    async def members_with_role(self, guild_id, role_name):
+        raise NotImplementedError
+
+    async def load_reaction_roles(self):
+        # (message_id, kind, guild_id, channel_id, emoji, role_name) rows
+        raise NotImplementedError
+
+    async def save_reaction_roles(self, guild_id, channel_id, message_id,
+                                  kind, roles):
+        # Replaces the guild's previous role message of the same kind
+        raise NotImplementedError
+
+    async def load_rules_channels(self):
+        # {guild_id: channel_id}
+        raise NotImplementedError
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        raise NotImplementedError
+
+    async def count_members(self, guild_id):
+        raise NotImplementedError
+
+    async def fetch_members_page(self, guild_id, after_id, limit):
+        raise NotImplementedError
+
+    async def fetch_member_rows(self, guild_id, after_user_id, limit):
+        # (user_id, username, has_general, has_singles, has_doubles) rows in
+        # user ID order, for streaming a guild out
+        raise NotImplementedError
+
+    async def guild_summaries(self):
+        # (guild_id, members, has_general, has_singles, has_doubles) rows,
+        # one per guild
+        raise NotImplementedError
+
+    async def get_sync_watermark(self, guild_id):
+        # Fingerprint of the guild's last sync, '' once member writes have
+        # made it stale, or None if the guild has never been synced
+        raise NotImplementedError
+
+    async def apply_member_diff(self, guild_id, fingerprint, inserts, updates,
+                                deletes):
+        # inserts are (user_id, username, has_general, has_singles,
+        # has_doubles), updates are (username, has_general, has_singles,
+        # has_doubles, user_id) and deletes are user IDs, all within guild_id
+        raise NotImplementedError
@@ -0,0 +1,207 @@
+# Write-through LRU/TTL cache of member state in front of another backend
+import time
+from collections import OrderedDict
+
+from .base import ROLE_COLUMNS, Storage
+
+# Position of each role's flag within a member's state tuple
+ROLE_INDEX = {name: i + 1 for i, name in enumerate(ROLE_COLUMNS)}
+# Query results ($bot database pages, "who has role X") kept at once
+QUERY_CACHE_SIZE = 256
+
+
+class MemberStateCache:
+    # (guild_id, user_id) -> (username, has_general, has_singles,
+    # has_doubles), least recently used first
+
+    def __init__(self, size, ttl):
+        self.size = size
+        # Entries expire so state written by another process is picked up
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, state)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def peek(self, key):
+        # Like get, without counting or refreshing the entry
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def put(self, key, state):
+        self._entries[key] = (time.monotonic() + self.ttl, state)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def rename(self, user_id, username):
+        # Renames are rare, so a scan beats keeping a per-user index
+        for key, (expires, state) in self._entries.items():
+            if key[1] == user_id:
+                self._entries[key] = (expires, (username, *state[1:]))
+
+
+class CachedStorage(Storage):
+
+    def __init__(self, storage, size=10000, ttl=300):
+        super().__init__()
+        self.storage = storage
+        self.cache = MemberStateCache(size, ttl)
+        # Whole query results, keyed by the query and its guild's write
+        # generation. Every write through here bumps the generation, so a
+        # stale result is never hit again and just ages out.
+        self.queries = MemberStateCache(QUERY_CACHE_SIZE, ttl)
+        # guild_id -> generation, plus one for renames, which touch every
+        # guild
+        self._generations = {}
+        self._rename_generation = 0
+
+    @property
+    def pending_writes(self):
+        return self.storage.pending_writes
+
+    async def connect(self):
+        await self.storage.connect()
+        self.ready = True
+
+    async def flush(self):
+        await self.storage.flush()
+
+    async def close(self):
+        await self.storage.close()
+
+    def batch(self):
+        return self.storage.batch()
+
+    def _changed(self, guild_id):
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+
+    async def _query(self, name, guild_id, *args):
+        key = (name, guild_id, self._generations.get(guild_id, 0),
+               self._rename_generation, *args)
+        result = self.queries.get(key)
+        if result is None:
+            result = await getattr(self.storage, name)(guild_id, *args)
+            self.queries.put(key, result)
+        return result
+
+    async def get_member_state(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        state = self.cache.get(key)
+        if state is None:
+            state = await self.storage.get_member_state(guild_id, user_id)
+            if state is not None:
+                self.cache.put(key, state)
+        return state
+
+    async def upsert_member(self, guild_id, user_id, username, flags):
+        key = (guild_id, user_id)
+        state = (username, *flags)
+        # The role edit that triggered this was usually just recorded
+        if self.cache.peek(key) == state:
+            return
+        await self.storage.upsert_member(guild_id, user_id, username, flags)
+        self.cache.put(key, state)
+        self._changed(guild_id)
+
+    async def rename_member(self, user_id, username):
+        await self.storage.rename_member(user_id, username)
+        self.cache.rename(user_id, username)
+        self._rename_generation += 1
+
+    async def delete_member(self, guild_id, user_id):
+        await self.storage.delete_member(guild_id, user_id)
+        self.cache.pop((guild_id, user_id))
+        self._changed(guild_id)
+
+    async def set_member_role(self, guild_id, user_id, role_name, value):
+        key = (guild_id, user_id)
+        state = self.cache.peek(key)
+        if state is not None and role_name in ROLE_INDEX:
+            index = ROLE_INDEX[role_name]
+            flag = 1 if value else 0
+            if state[index] == flag:
+                return
+            self.cache.put(key,
+                           (*state[:index], flag, *state[index + 1:]))
+        await self.storage.set_member_role(guild_id, user_id, role_name,
+                                           value)
+        self._changed(guild_id)
+
+    async def apply_member_diff(self, guild_id, fingerprint, inserts, updates,
+                                deletes):
+        result = await self.storage.apply_member_diff(guild_id, fingerprint,
+                                                      inserts, updates,
+                                                      deletes)
+        # Refresh members we already hold rather than filling the cache with
+        # a whole guild
+        for username, *flags, user_id in updates:
+            key = (guild_id, user_id)
+            if self.cache.peek(key) is not None:
+                self.cache.put(key, (username, *flags))
+        for user_id in deletes:
+            self.cache.pop((guild_id, user_id))
+        self._changed(guild_id)
+        return result
+
+    # Paging back and forth through $bot database, and repeated from:<role>
+    # lookups, are served from the query cache
+
+    async def fetch_members_page(self, guild_id, after_id, limit):
+        return await self._query('fetch_members_page', guild_id, after_id,
+                                 limit)
+
+    async def members_with_role(self, guild_id, role_name):
+        return await self._query('members_with_role', guild_id, role_name)
+
+    # Everything else goes straight to the backend: whole-guild reads and
+    # exports would only push everything else out of the cache
+
+    async def load_member_flags(self, guild_id):
+        return await self.storage.load_member_flags(guild_id)
+
+    async def load_reaction_roles(self):
+        return await self.storage.load_reaction_roles()
+
+    async def save_reaction_roles(self, guild_id, channel_id, message_id,
+                                  kind, roles):
+        await self.storage.save_reaction_roles(guild_id, channel_id,
+                                               message_id, kind, roles)
+
+    async def load_rules_channels(self):
+        return await self.storage.load_rules_channels()
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        await self.storage.set_rules_channel(guild_id, channel_id)
+
+    async def count_members(self, guild_id):
+        return await self.storage.count_members(guild_id)
+
+    async def fetch_member_rows(self, guild_id, after_user_id, limit):
+        return await self.storage.fetch_member_rows(guild_id, after_user_id,
+                                                    limit)
+
+    async def guild_summaries(self):
+        return await self.storage.guild_summaries()
+
+    async def get_sync_watermark(self, guild_id):
+        return await self.storage.get_sync_watermark(guild_id)
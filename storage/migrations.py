@@ -0,0 +1,139 @@
+# Versioned schema migrations, tracked with SQLite's user_version pragma
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _initial_schema(conn):
+    # Schema as it was before versioning; IF NOT EXISTS so databases created
+    # by older releases pass through unchanged
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS server_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            has_general_role BOOLEAN DEFAULT 0,
+            has_singles_role BOOLEAN DEFAULT 0,
+            has_doubles_role BOOLEAN DEFAULT 0,
+            UNIQUE(username)
+        )
+    ''')
+
+    # Fingerprint of each guild's member state at its last sync
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS guild_sync_state (
+            guild_id INTEGER PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            synced_at REAL NOT NULL
+        )
+    ''')
+
+    # Emoji -> role tables of the bot's reaction-role messages
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reaction_roles (
+            message_id INTEGER NOT NULL,
+            emoji TEXT NOT NULL,
+            role_name TEXT NOT NULL,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (message_id, emoji)
+        )
+    ''')
+
+
+def _per_guild_members(conn):
+    # Key members by (guild_id, user_id) instead of username. Username-keyed
+    # rows can't be attributed to a guild, so they are dropped and the sync
+    # watermarks cleared; the next sync rebuilds every guild from live state.
+    conn.execute('DROP TABLE server_members')
+    conn.execute('''
+        CREATE TABLE server_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            has_general_role BOOLEAN NOT NULL DEFAULT 0,
+            has_singles_role BOOLEAN NOT NULL DEFAULT 0,
+            has_doubles_role BOOLEAN NOT NULL DEFAULT 0,
+            UNIQUE(guild_id, user_id)
+        )
+    ''')
+    # Keyset pagination within a guild
+    conn.execute(
+        'CREATE INDEX idx_server_members_guild ON server_members (guild_id, id)'
+    )
+    # Covering indexes for "who in this guild has role X"
+    for column in ('has_general_role', 'has_singles_role', 'has_doubles_role'):
+        conn.execute(f'''
+            CREATE INDEX idx_server_members_{column}
+            ON server_members (guild_id, {column}, user_id)
+        ''')
+    conn.execute('DELETE FROM guild_sync_state')
+
+
+def _role_message_kinds(conn):
+    # Record which role message ('rules' or 'singles_doubles') each entry
+    # belongs to, and each guild's rules channel, so the bootstrap can look
+    # its messages up instead of scanning channel history
+    conn.execute('ALTER TABLE reaction_roles ADD COLUMN kind TEXT')
+    conn.execute('''
+        UPDATE reaction_roles
+        SET kind = CASE WHEN role_name = 'general' THEN 'rules' ELSE 'singles_doubles' END
+    ''')
+    conn.execute(
+        'CREATE INDEX idx_reaction_roles_guild ON reaction_roles (guild_id, kind)'
+    )
+    conn.execute('''
+        CREATE TABLE rules_channels (
+            guild_id INTEGER PRIMARY KEY,
+            channel_id INTEGER NOT NULL
+        )
+    ''')
+
+
+def _shard_layout(conn):
+    # Which shard of how many a shard database file holds. Guilds are mapped
+    # to shards by the shard count, so a file is only valid for one count.
+    # Stays empty in an unsharded database.
+    conn.execute('''
+        CREATE TABLE shard_layout (
+            shard_id INTEGER NOT NULL,
+            shard_count INTEGER NOT NULL
+        )
+    ''')
+
+
+def _user_index(conn):
+    # A user's rows across guilds, for renames and the sync watermarks they
+    # clear; every other index leads with guild_id
+    conn.execute(
+        'CREATE INDEX idx_server_members_user ON server_members (user_id)')
+
+
+# Append only: a migration's position is its version number
+MIGRATIONS = [
+    _initial_schema,
+    _per_guild_members,
+    _role_message_kinds,
+    _shard_layout,
+    _user_index,
+]
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:],
+                                       start=version + 1):
+        # Each migration and its version bump commit together
+        conn.execute('BEGIN')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info('Applied database migration',
+                 extra={
+                     'version': number,
+                     'migration': migration.__name__
+                 })
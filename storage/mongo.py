@@ -0,0 +1,280 @@
+# MongoDB storage on pymongo's asyncio client
+import logging
+import time
+
+from pymongo import ASCENDING, AsyncMongoClient, DeleteOne, UpdateMany, UpdateOne
+
+from metrics import DB_SECONDS
+
+from .base import ROLE_COLUMNS, Storage
+
+log = logging.getLogger(__name__)
+
+FLAG_FIELDS = ('has_general_role', 'has_singles_role', 'has_doubles_role')
+
+
+def fix_uri(uri):
+    # Fix URI format if needed (replace # with ?)
+    if '#' in uri and '?' not in uri:
+        uri = uri.replace('#', '?')
+        log.info('Fixed MongoDB URI format')
+    return uri
+
+
+def _member_fields(username, flags):
+    fields = dict(zip(FLAG_FIELDS, flags))
+    fields['username'] = username
+    return fields
+
+
+class MongoStorage(Storage):
+
+    def __init__(self, uri, flush_interval=0.05, flush_ops=100,
+                 timeout_ms=5000):
+        super().__init__(flush_interval, flush_ops)
+        self.uri = fix_uri(uri)
+        self.timeout_ms = timeout_ms
+        self.client = None
+        self.db = None
+
+    async def _connect(self):
+        # Try without SSL first (for Replit compatibility), then fall back to
+        # TLS; a ping confirms the connection actually works
+        error = None
+        for options in ({'ssl': False}, {'tls': True}):
+            client = AsyncMongoClient(self.uri,
+                                      serverSelectionTimeoutMS=self.timeout_ms,
+                                      connectTimeoutMS=self.timeout_ms,
+                                      **options)
+            try:
+                await client.admin.command('ping')
+            except Exception as e:
+                error = e
+                await client.close()
+                continue
+            self.client = client
+            break
+        else:
+            raise error
+        log.info('Connected to MongoDB')
+
+        # Uses default database from URI
+        self.db = self.client.get_default_database('tennis')
+        members = self.db.server_members
+        await members.create_index([('guild_id', ASCENDING),
+                                    ('user_id', ASCENDING)],
+                                   unique=True)
+        # "Who in this guild has role X" is answered from the index alone
+        for field in FLAG_FIELDS:
+            await members.create_index([('guild_id', ASCENDING),
+                                        (field, ASCENDING),
+                                        ('user_id', ASCENDING)])
+        # Renames touch a user's rows in every guild
+        await members.create_index([('user_id', ASCENDING)])
+        await self.db.reaction_roles.create_index([('guild_id', ASCENDING),
+                                                   ('kind', ASCENDING)])
+
+    async def close(self):
+        await super().close()
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def _write_batch(self, ops, stale_guilds, stale_users):
+        # ops are member write models; ordered keeps queue order. Watermarks
+        # are cleared first, so a failed write can only cost a full sync.
+        with DB_SECONDS.time(op='write_batch'):
+            if stale_users:
+                stale_guilds |= set(await self.db.server_members.distinct(
+                    'guild_id', {'user_id': {
+                        '$in': list(stale_users)
+                    }}))
+            if stale_guilds:
+                await self.db.guild_sync_state.update_many(
+                    {'_id': {
+                        '$in': list(stale_guilds)
+                    }}, {'$set': {
+                        'fingerprint': ''
+                    }})
+            await self.db.server_members.bulk_write(ops, ordered=True)
+
+    async def load_member_flags(self, guild_id):
+        await self.flush()
+        stored = {}
+        with DB_SECONDS.time(op='load_member_flags'):
+            async for doc in self.db.server_members.find(
+                {'guild_id': guild_id}):
+                stored[doc['user_id']] = (doc['username'],
+                                          *(doc.get(field, 0)
+                                            for field in FLAG_FIELDS))
+        return stored
+
+    async def get_member_state(self, guild_id, user_id):
+        await self.flush()
+        doc = await self.db.server_members.find_one({
+            'guild_id': guild_id,
+            'user_id': user_id
+        })
+        if doc is None:
+            return None
+        return (doc['username'], *(doc.get(field, 0) for field in FLAG_FIELDS))
+
+    async def upsert_member(self, guild_id, user_id, username, flags):
+        self._invalidate_watermark(guild_id)
+        await self._queue(
+            UpdateOne({
+                'guild_id': guild_id,
+                'user_id': user_id
+            }, {'$set': _member_fields(username, flags)},
+                      upsert=True))
+
+    async def rename_member(self, user_id, username):
+        # Usernames are global, so every guild's document follows the rename
+        self._invalidate_user_watermarks(user_id)
+        await self._queue(
+            UpdateMany({'user_id': user_id}, {'$set': {
+                'username': username
+            }}))
+
+    async def delete_member(self, guild_id, user_id):
+        self._invalidate_watermark(guild_id)
+        await self._queue(DeleteOne({'guild_id': guild_id, 'user_id': user_id}))
+
+    async def set_member_role(self, guild_id, user_id, role_name, value):
+        field = ROLE_COLUMNS.get(role_name)
+        if field is None:
+            return
+        self._invalidate_watermark(guild_id)
+        await self._queue(
+            UpdateOne({
+                'guild_id': guild_id,
+                'user_id': user_id
+            }, {'$set': {
+                field: 1 if value else 0
+            }}))
+
+    async def members_with_role(self, guild_id, role_name):
+        await self.flush()
+        field = ROLE_COLUMNS[role_name]
+        cursor = self.db.server_members.find({
+            'guild_id': guild_id,
+            field: 1
+        }, {
+            '_id': 0,
+            'user_id': 1
+        })
+        return [doc['user_id'] async for doc in cursor]
+
+    async def load_reaction_roles(self):
+        return [(doc['_id'], doc['kind'], doc['guild_id'], doc['channel_id'],
+                 entry['emoji'], entry['role_name'])
+                async for doc in self.db.reaction_roles.find()
+                for entry in doc['roles']]
+
+    async def save_reaction_roles(self, guild_id, channel_id, message_id,
+                                  kind, roles):
+        # The new message replaces the guild's previous one of its kind
+        await self.db.reaction_roles.delete_many({
+            'guild_id': guild_id,
+            'kind': kind
+        })
+        # Emoji are stored as values, not keys, so any emoji is a valid entry
+        await self.db.reaction_roles.replace_one({'_id': message_id}, {
+            'guild_id': guild_id,
+            'channel_id': channel_id,
+            'kind': kind,
+            'roles': [{
+                'emoji': emoji,
+                'role_name': role_name
+            } for emoji, role_name in roles.items()],
+        },
+                                                 upsert=True)
+
+    async def load_rules_channels(self):
+        return {
+            doc['_id']: doc['channel_id']
+            async for doc in self.db.rules_channels.find()
+        }
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        await self.db.rules_channels.replace_one({'_id': guild_id},
+                                                 {'channel_id': channel_id},
+                                                 upsert=True)
+
+    async def count_members(self, guild_id):
+        await self.flush()
+        return await self.db.server_members.count_documents(
+            {'guild_id': guild_id})
+
+    async def fetch_members_page(self, guild_id, after_id, limit):
+        # Keyset pagination on the (guild_id, user_id) index; the user ID is
+        # the row id here
+        await self.flush()
+        cursor = self.db.server_members.find({
+            'guild_id': guild_id,
+            'user_id': {
+                '$gt': after_id
+            }
+        }).sort('user_id', ASCENDING).limit(limit)
+        with DB_SECONDS.time(op='fetch_members_page'):
+            return [(doc['user_id'], doc['username'],
+                     *(doc.get(field, 0) for field in FLAG_FIELDS))
+                    async for doc in cursor]
+
+    async def fetch_member_rows(self, guild_id, after_user_id, limit):
+        # Pages are already keyed by user ID here
+        return await self.fetch_members_page(guild_id, after_user_id, limit)
+
+    async def guild_summaries(self):
+        await self.flush()
+        group = {'_id': '$guild_id', 'members': {'$sum': 1}}
+        group.update({field: {'$sum': f'${field}'} for field in FLAG_FIELDS})
+        cursor = await self.db.server_members.aggregate([{'$group': group}])
+        return [(doc['_id'], doc['members'],
+                 *(doc[field] for field in FLAG_FIELDS))
+                async for doc in cursor]
+
+    async def get_sync_watermark(self, guild_id):
+        # Queued writes may clear it
+        await self.flush()
+        doc = await self.db.guild_sync_state.find_one({'_id': guild_id})
+        return doc['fingerprint'] if doc else None
+
+    async def apply_member_diff(self, guild_id, fingerprint, inserts, updates,
+                                deletes):
+        self._watermark_written(guild_id)
+        await self.flush()
+        ops = [
+            UpdateOne({
+                'guild_id': guild_id,
+                'user_id': user_id
+            }, {'$set': _member_fields(username, flags)},
+                      upsert=True)
+            for user_id, username, *flags in inserts
+        ]
+        ops += [
+            UpdateOne({
+                'guild_id': guild_id,
+                'user_id': user_id
+            }, {'$set': _member_fields(username, flags)})
+            for username, *flags, user_id in updates
+        ]
+        ops += [
+            DeleteOne({
+                'guild_id': guild_id,
+                'user_id': user_id
+            }) for user_id in deletes
+        ]
+        if ops:
+            # Unordered lets the server apply the batch in parallel
+            with DB_SECONDS.time(op='apply_member_diff'):
+                await self.db.server_members.bulk_write(ops, ordered=False)
+        # Written last, so a failed batch is retried on the next sync
+        await self.db.guild_sync_state.update_one({'_id': guild_id}, {
+            '$set': {
+                'fingerprint': fingerprint,
+                'synced_at': time.time()
+            }
+        },
+                                                  upsert=True)
+        return len(ops)
@@ -0,0 +1,185 @@
+# SQLite split into one file per Discord shard. A shard runs in exactly one
+# process, so every file has a single writer and processes never contend for
+# the same database lock.
+import asyncio
+import glob
+import logging
+import os
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from .base import Storage
+from .sqlite import SQLiteStorage, read_guild_summaries, read_shard_layout
+
+log = logging.getLogger(__name__)
+
+
+def shard_for(guild_id, shard_count):
+    # Discord's own guild -> shard assignment
+    return (guild_id >> 22) % shard_count
+
+
+def shard_path(path, shard_id):
+    # tennis.db -> tennis.shard-3.db
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard-{shard_id}{ext}'
+
+
+def stored_shard_count(path):
+    # Shard count the existing shard files were written with, or None
+    root, ext = os.path.splitext(path)
+    for shard_file in sorted(glob.glob(f'{glob.escape(root)}.shard-*{ext}')):
+        layout = read_shard_layout(shard_file)
+        if layout is not None:
+            return layout[1]
+    return None
+
+
+class ShardedStorage(Storage):
+
+    def __init__(self, path, shard_count, shard_ids):
+        super().__init__()
+        self.path = path
+        self.shard_count = shard_count
+        # shard_id -> storage for the shards this process runs
+        self.shards = {
+            shard_id: SQLiteStorage(shard_path(path, shard_id))
+            for shard_id in shard_ids
+        }
+
+    @property
+    def pending_writes(self):
+        return sum(shard.pending_writes for shard in self.shards.values())
+
+    def _shard(self, guild_id):
+        shard_id = shard_for(guild_id, self.shard_count)
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            raise LookupError(
+                f"Guild {guild_id} is on shard {shard_id}, which this "
+                f"process doesn't run")
+        return shard
+
+    async def connect(self):
+        for shard_id, shard in self.shards.items():
+            new = not os.path.exists(shard.path)
+            await shard.connect()
+            # Guilds map to shards by the shard count, so a file written with
+            # another count holds the wrong guilds
+            layout = await shard.get_shard_layout()
+            if layout is not None and layout != (shard_id, self.shard_count):
+                raise ValueError(
+                    f"{shard.path} holds shard {layout[0]} of {layout[1]}, "
+                    f"not {shard_id} of {self.shard_count}; run with "
+                    f"{layout[1]} shards")
+            if layout is None:
+                await shard.set_shard_layout(shard_id, self.shard_count)
+            # The first start after switching to shards moves each shard's
+            # guilds over from the single database file
+            if new and os.path.exists(self.path):
+                copied = await shard.seed_from(self.path, shard_id,
+                                               self.shard_count)
+                if copied is None:
+                    log.warning('Not seeding shard from an older schema',
+                                extra={
+                                    'shard': shard_id,
+                                    'source': self.path
+                                })
+                else:
+                    log.info('Seeded shard database',
+                             extra={
+                                 'shard': shard_id,
+                                 'rows': copied
+                             })
+        self.ready = True
+
+    async def flush(self):
+        await asyncio.gather(
+            *(shard.flush() for shard in self.shards.values()))
+
+    async def close(self):
+        await asyncio.gather(
+            *(shard.close() for shard in self.shards.values()))
+
+    @asynccontextmanager
+    async def batch(self):
+        async with AsyncExitStack() as stack:
+            for shard in self.shards.values():
+                await stack.enter_async_context(shard.batch())
+            yield
+
+    async def load_member_flags(self, guild_id):
+        return await self._shard(guild_id).load_member_flags(guild_id)
+
+    async def get_member_state(self, guild_id, user_id):
+        return await self._shard(guild_id).get_member_state(guild_id, user_id)
+
+    async def upsert_member(self, guild_id, user_id, username, flags):
+        await self._shard(guild_id).upsert_member(guild_id, user_id,
+                                                  username, flags)
+
+    async def rename_member(self, user_id, username):
+        # A user can be in guilds on any of our shards
+        await asyncio.gather(*(shard.rename_member(user_id, username)
+                               for shard in self.shards.values()))
+
+    async def delete_member(self, guild_id, user_id):
+        await self._shard(guild_id).delete_member(guild_id, user_id)
+
+    async def set_member_role(self, guild_id, user_id, role_name, value):
+        await self._shard(guild_id).set_member_role(guild_id, user_id,
+                                                    role_name, value)
+
+    async def members_with_role(self, guild_id, role_name):
+        return await self._shard(guild_id).members_with_role(
+            guild_id, role_name)
+
+    async def load_reaction_roles(self):
+        rows = []
+        for shard in self.shards.values():
+            rows += await shard.load_reaction_roles()
+        return rows
+
+    async def save_reaction_roles(self, guild_id, channel_id, message_id,
+                                  kind, roles):
+        await self._shard(guild_id).save_reaction_roles(
+            guild_id, channel_id, message_id, kind, roles)
+
+    async def load_rules_channels(self):
+        channels = {}
+        for shard in self.shards.values():
+            channels.update(await shard.load_rules_channels())
+        return channels
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        await self._shard(guild_id).set_rules_channel(guild_id, channel_id)
+
+    async def count_members(self, guild_id):
+        return await self._shard(guild_id).count_members(guild_id)
+
+    async def fetch_members_page(self, guild_id, after_id, limit):
+        return await self._shard(guild_id).fetch_members_page(
+            guild_id, after_id, limit)
+
+    async def fetch_member_rows(self, guild_id, after_user_id, limit):
+        return await self._shard(guild_id).fetch_member_rows(
+            guild_id, after_user_id, limit)
+
+    async def guild_summaries(self):
+        # Our shards through their writers; every other shard's file is read
+        # directly, which makes this the cross-process view
+        rows = []
+        for shard in self.shards.values():
+            rows += await shard.guild_summaries()
+        for shard_id in range(self.shard_count):
+            path = shard_path(self.path, shard_id)
+            if shard_id not in self.shards and os.path.exists(path):
+                rows += await asyncio.to_thread(read_guild_summaries, path)
+        return rows
+
+    async def get_sync_watermark(self, guild_id):
+        return await self._shard(guild_id).get_sync_watermark(guild_id)
+
+    async def apply_member_diff(self, guild_id, fingerprint, inserts, updates,
+                                deletes):
+        return await self._shard(guild_id).apply_member_diff(
+            guild_id, fingerprint, inserts, updates, deletes)
@@ -0,0 +1,373 @@
+# SQLite storage that runs every statement on a dedicated writer thread
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import DB_SECONDS
+
+from .base import ROLE_COLUMNS, Storage
+from .migrations import MIGRATIONS, migrate
+
+# Applied to every new connection. WAL lets readers run alongside the
+# writer, and synchronous=NORMAL only fsyncs at checkpoints, which in WAL
+# mode can lose the last commits on power loss but never corrupts the file.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # KiB, i.e. 16 MB of page cache
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Per-guild member and role counts, for the cross-guild summary
+GUILD_SUMMARY_SQL = '''
+    SELECT guild_id, COUNT(*), SUM(has_general_role), SUM(has_singles_role), SUM(has_doubles_role)
+    FROM server_members
+    GROUP BY guild_id
+'''
+
+# Tables holding per-guild state, copied when seeding a shard, and the
+# schema version they last changed in; older sources can't be copied
+GUILD_TABLES = ('server_members', 'guild_sync_state', 'reaction_roles',
+                'rules_channels')
+GUILD_TABLES_VERSION = 3
+
+
+def _read_only(path, sql):
+    # Read-only look at a database another process is writing; WAL lets this
+    # run alongside that process's writer
+    conn = sqlite3.connect(f'{Path(path).absolute().as_uri()}?mode=ro',
+                           uri=True)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def read_guild_summaries(path):
+    return _read_only(path, GUILD_SUMMARY_SQL)
+
+
+def read_shard_layout(path):
+    # (shard_id, shard_count) recorded in a shard file, or None
+    try:
+        rows = _read_only(path, 'SELECT shard_id, shard_count FROM shard_layout')
+    except sqlite3.OperationalError:
+        # Missing file, or not migrated this far yet
+        return None
+    return tuple(rows[0]) if rows else None
+
+
+class SQLiteStorage(Storage):
+
+    def __init__(self, path, flush_interval=0.05, flush_ops=100):
+        super().__init__(flush_interval, flush_ops)
+        self.path = path
+        # One worker thread owns the connection, so statements are serialized
+        # and never block the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='sqlite-writer')
+        self._conn = None
+
+    def _connection(self):
+        # Only ever called from the writer thread
+        if self._conn is None:
+            # The module keeps compiled statements keyed by SQL text, so the
+            # fixed statements below are prepared once and reused
+            conn = sqlite3.connect(self.path, cached_statements=256)
+            # Only kept once fully set up, so a failed attempt (e.g. the
+            # database is locked) is retried from scratch
+            try:
+                for pragma in PRAGMAS:
+                    conn.execute(pragma)
+                migrate(conn)
+            except Exception:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    async def run(self, func, *args, op=None):
+        # Run func(conn, *args) on the writer thread and wait for the result;
+        # the time recorded includes waiting for the writer to be free
+        loop = asyncio.get_running_loop()
+        with DB_SECONDS.time(op=op or func.__name__.lstrip('_')):
+            return await loop.run_in_executor(
+                self._executor, lambda: func(self._connection(), *args))
+
+    async def execute(self, sql, params=()):
+        # Queued writes go first so reads always see them
+        await self.flush()
+
+        def _execute(conn):
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+
+        return await self.run(_execute, op=sql.split(None, 1)[0].lower())
+
+    async def executemany(self, sql, rows):
+        await self.flush()
+
+        def _executemany(conn):
+            # One transaction for the whole batch
+            with conn:
+                conn.executemany(sql, rows)
+            return len(rows)
+
+        return await self.run(_executemany)
+
+    async def _connect(self):
+        # Opening the connection runs the pragmas and any pending migrations
+
+        def _connect(conn):
+            pass
+
+        await self.run(_connect)
+
+    async def _write_batch(self, ops, stale_guilds, stale_users):
+        # ops are (sql, params); one transaction for the whole batch
+
+        def _write_batch(conn):
+            with conn:
+                conn.executemany(
+                    "UPDATE guild_sync_state SET fingerprint = '' WHERE guild_id = ?",
+                    [(guild_id, ) for guild_id in stale_guilds])
+                conn.executemany(
+                    '''
+                    UPDATE guild_sync_state SET fingerprint = ''
+                    WHERE guild_id IN (SELECT guild_id FROM server_members WHERE user_id = ?)
+                ''', [(user_id, ) for user_id in stale_users])
+                for sql, params in ops:
+                    conn.execute(sql, params)
+
+        await self.run(_write_batch)
+
+    async def load_member_flags(self, guild_id):
+        # {user_id: (username, has_general, has_singles, has_doubles)} for one
+        # guild in one query
+        rows = await self.execute(
+            '''
+            SELECT user_id, username, has_general_role, has_singles_role, has_doubles_role
+            FROM server_members
+            WHERE guild_id = ?
+        ''', (guild_id, ))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    async def get_member_state(self, guild_id, user_id):
+        rows = await self.execute(
+            '''
+            SELECT username, has_general_role, has_singles_role, has_doubles_role
+            FROM server_members
+            WHERE guild_id = ? AND user_id = ?
+        ''', (guild_id, user_id))
+        return tuple(rows[0]) if rows else None
+
+    async def upsert_member(self, guild_id, user_id, username, flags):
+        self._invalidate_watermark(guild_id)
+        await self._queue(('''
+            INSERT INTO server_members
+            (guild_id, user_id, username, has_general_role, has_singles_role, has_doubles_role)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET
+                username = excluded.username,
+                has_general_role = excluded.has_general_role,
+                has_singles_role = excluded.has_singles_role,
+                has_doubles_role = excluded.has_doubles_role
+        ''', (guild_id, user_id, username, *flags)))
+
+    async def rename_member(self, user_id, username):
+        # Usernames are global, so every guild's row follows the rename
+        self._invalidate_user_watermarks(user_id)
+        await self._queue(
+            ('UPDATE server_members SET username = ? WHERE user_id = ?',
+             (username, user_id)))
+
+    async def delete_member(self, guild_id, user_id):
+        self._invalidate_watermark(guild_id)
+        await self._queue(
+            ('DELETE FROM server_members WHERE guild_id = ? AND user_id = ?',
+             (guild_id, user_id)))
+
+    async def set_member_role(self, guild_id, user_id, role_name, value):
+        column = ROLE_COLUMNS.get(role_name)
+        if column is None:
+            return
+        self._invalidate_watermark(guild_id)
+        await self._queue(
+            (f'UPDATE server_members SET {column} = ? WHERE guild_id = ? AND user_id = ?',
+             (1 if value else 0, guild_id, user_id)))
+
+    async def members_with_role(self, guild_id, role_name):
+        # Served entirely from the covering index on (guild_id, flag, user_id)
+        column = ROLE_COLUMNS[role_name]
+        rows = await self.execute(
+            f'SELECT user_id FROM server_members WHERE guild_id = ? AND {column} = 1',
+            (guild_id, ))
+        return [row[0] for row in rows]
+
+    async def load_reaction_roles(self):
+        return await self.execute('''
+            SELECT message_id, kind, guild_id, channel_id, emoji, role_name
+            FROM reaction_roles
+        ''')
+
+    async def save_reaction_roles(self, guild_id, channel_id, message_id,
+                                  kind, roles):
+
+        def _save_reaction_roles(conn):
+            with conn:
+                # The new message replaces the guild's previous one of its kind
+                conn.execute(
+                    'DELETE FROM reaction_roles WHERE guild_id = ? AND kind = ?',
+                    (guild_id, kind))
+                conn.executemany(
+                    '''
+                    INSERT OR REPLACE INTO reaction_roles
+                    (message_id, emoji, role_name, guild_id, channel_id, kind)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(message_id, emoji, role_name, guild_id, channel_id, kind)
+                      for emoji, role_name in roles.items()])
+
+        await self.run(_save_reaction_roles)
+
+    async def load_rules_channels(self):
+        rows = await self.execute(
+            'SELECT guild_id, channel_id FROM rules_channels')
+        return dict(rows)
+
+    async def set_rules_channel(self, guild_id, channel_id):
+        await self.execute(
+            'INSERT OR REPLACE INTO rules_channels (guild_id, channel_id) VALUES (?, ?)',
+            (guild_id, channel_id))
+
+    async def count_members(self, guild_id):
+        rows = await self.execute(
+            'SELECT COUNT(*) FROM server_members WHERE guild_id = ?',
+            (guild_id, ))
+        return rows[0][0]
+
+    async def fetch_members_page(self, guild_id, after_id, limit):
+        # Keyset pagination on (guild_id, id): cost stays flat however deep
+        # the page is, unlike OFFSET
+        return await self.execute(
+            '''
+            SELECT id, username, has_general_role, has_singles_role, has_doubles_role
+            FROM server_members
+            WHERE guild_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (guild_id, after_id, limit))
+
+    async def fetch_member_rows(self, guild_id, after_user_id, limit):
+        # Keyset pagination on the UNIQUE(guild_id, user_id) index
+        return await self.execute(
+            '''
+            SELECT user_id, username, has_general_role, has_singles_role, has_doubles_role
+            FROM server_members
+            WHERE guild_id = ? AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+        ''', (guild_id, after_user_id, limit))
+
+    async def get_sync_watermark(self, guild_id):
+        rows = await self.execute(
+            'SELECT fingerprint FROM guild_sync_state WHERE guild_id = ?',
+            (guild_id, ))
+        return rows[0][0] if rows else None
+
+    async def apply_member_diff(self, guild_id, fingerprint, inserts, updates,
+                                deletes):
+        # inserts are (user_id, username, has_general, has_singles,
+        # has_doubles), updates are (username, has_general, has_singles,
+        # has_doubles, user_id) and deletes are user IDs, all within guild_id.
+        # Existing rows are updated in place rather than replaced, so their
+        # ids and index entries stay put.
+
+        self._watermark_written(guild_id)
+        await self.flush()
+
+        def _apply_member_diff(conn):
+            with conn:
+                conn.executemany(
+                    '''
+                    INSERT INTO server_members
+                    (guild_id, user_id, username, has_general_role, has_singles_role, has_doubles_role)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(guild_id, *row) for row in inserts])
+                conn.executemany(
+                    '''
+                    UPDATE server_members
+                    SET username = ?, has_general_role = ?, has_singles_role = ?, has_doubles_role = ?
+                    WHERE guild_id = ? AND user_id = ?
+                ''', [(*row[:-1], guild_id, row[-1]) for row in updates])
+                conn.executemany(
+                    'DELETE FROM server_members WHERE guild_id = ? AND user_id = ?',
+                    [(guild_id, user_id) for user_id in deletes])
+                conn.execute(
+                    '''
+                    INSERT OR REPLACE INTO guild_sync_state
+                    (guild_id, fingerprint, synced_at)
+                    VALUES (?, ?, ?)
+                ''', (guild_id, fingerprint, time.time()))
+            return len(inserts) + len(updates) + len(deletes)
+
+        return await self.run(_apply_member_diff)
+
+    async def guild_summaries(self):
+        return await self.execute(GUILD_SUMMARY_SQL)
+
+    async def get_shard_layout(self):
+        rows = await self.execute(
+            'SELECT shard_id, shard_count FROM shard_layout')
+        return tuple(rows[0]) if rows else None
+
+    async def set_shard_layout(self, shard_id, shard_count):
+
+        def _set_shard_layout(conn):
+            with conn:
+                conn.execute('DELETE FROM shard_layout')
+                conn.execute(
+                    'INSERT INTO shard_layout (shard_id, shard_count) VALUES (?, ?)',
+                    (shard_id, shard_count))
+
+        await self.run(_set_shard_layout)
+
+    async def seed_from(self, path, shard_id, shard_count):
+        # Copy the guilds belonging to one shard out of another database
+        # file, such as the single tennis.db used before sharding
+
+        def _seed_from(conn):
+            conn.execute('ATTACH DATABASE ? AS source', (str(path), ))
+            try:
+                version = conn.execute(
+                    'PRAGMA source.user_version').fetchone()[0]
+                if not GUILD_TABLES_VERSION <= version <= len(MIGRATIONS):
+                    return None
+                copied = 0
+                with conn:
+                    for table in GUILD_TABLES:
+                        copied += conn.execute(
+                            f'''
+                            INSERT OR IGNORE INTO main.{table}
+                            SELECT * FROM source.{table}
+                            WHERE (guild_id >> 22) % ? = ?
+                        ''', (shard_count, shard_id)).rowcount
+                return copied
+            finally:
+                conn.execute('DETACH DATABASE source')
+
+        return await self.run(_seed_from)
+
+    async def close(self):
+        await super().close()
+
+        def _close(conn):
+            conn.close()
+
+        if self._conn is not None:
+            await self.run(_close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
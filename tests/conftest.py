@@ -0,0 +1,52 @@
+# Shared fixtures. Fake guilds and members come from benchmark.py, so the
+# tests and the benchmarks exercise the same stand-ins for Discord.
+import asyncio
+import itertools
+
+import pytest
+
+from benchmark import FakeGuild
+
+# Guild IDs are never reused, since role_index caches roles per guild ID
+_guild_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def make_guild():
+
+    def make_guild(members=10, seed=1, api_latency=0):
+        return FakeGuild(next(_guild_ids), members, api_latency, seed)
+
+    return make_guild
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'tennis.db')
+
+
+@pytest.fixture
+def bot(db_path, monkeypatch):
+    # main.py with a fake client and fresh storage, registry, queues and
+    # bitsets in place of its globals, as benchmark.py sets it up. Storage
+    # is connected inside each test's event loop.
+    import main
+    from benchmark import FakeClient
+    from lean_members import MemberBitsets
+    from reaction_buffer import ReactionBuffer
+    from reaction_roles import ReactionRoleRegistry
+    from role_queue import RoleMutationQueue
+    from storage import SQLiteStorage
+
+    db = SQLiteStorage(db_path)
+    monkeypatch.setattr(main, 'client', FakeClient())
+    monkeypatch.setattr(main, 'db', db)
+    monkeypatch.setattr(main, 'reaction_roles', ReactionRoleRegistry(db))
+    monkeypatch.setattr(
+        main, 'role_queue',
+        RoleMutationQueue(on_applied=main.record_role_changes, delay=0))
+    monkeypatch.setattr(main, 'reaction_buffer',
+                        ReactionBuffer(main.apply_reaction_batch, window=0))
+    monkeypatch.setattr(main, 'member_bits', MemberBitsets())
+    monkeypatch.setattr(main, 'storage_ready', asyncio.Event())
+    return main
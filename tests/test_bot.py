@@ -0,0 +1,198 @@
+# main.py's handlers against benchmark.py's fake client and guilds
+import asyncio
+from types import SimpleNamespace
+
+from member_sync import sync_server_members
+from storage import SQLiteStorage
+
+
+def test_close_applies_queued_changes(bot, make_guild, db_path):
+    guild = make_guild(members=1)
+    bot.client.guilds = [guild]
+    member = guild.members[0]
+    singles = guild.roles[1]
+    member._roles.pop(singles.id, None)
+
+    async def scenario():
+        await bot.db.connect()
+        await sync_server_members(bot.db, guild)
+        # Writes stay queued until something flushes them
+        bot.db.flush_interval = 60
+        bot.reaction_buffer.add(guild.id, member.id, 'singles', True, member)
+
+        tennis = bot.TennisBot(command_prefix=bot.COMMAND_PREFIX,
+                               intents=bot.intents)
+        await tennis.close()
+        assert tennis.is_closed()
+
+        reopened = SQLiteStorage(db_path)
+        await reopened.connect()
+        state = await reopened.get_member_state(guild.id, member.id)
+        await reopened.close()
+        return state
+
+    state = asyncio.run(scenario())
+    assert singles.id in member._roles
+    assert state == (member.name, *(int(role.id in member._roles)
+                                    for role in guild.roles))
+
+
+def test_reactions_in_one_guild_dont_wait_for_another(bot, make_guild):
+    # Every role edit in the slow guild takes half a second
+    slow = make_guild(members=1, api_latency=0.5)
+    fast = make_guild(members=1)
+    bot.client.guilds = [slow, fast]
+    for guild in (slow, fast):
+        guild.members[0]._roles.clear()
+
+    async def has_singles(guild):
+        member = guild.members[0]
+        while guild.roles[1].id not in member._roles:
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        await bot.db.connect()
+        for guild in (slow, fast):
+            await sync_server_members(bot.db, guild)
+        bot.reaction_buffer.add(slow.id, slow.members[0].id, 'singles', True)
+        await asyncio.sleep(0.05)
+        # Group commit isn't held open while the slow edit runs
+        assert bot.db._batches == 0
+        bot.reaction_buffer.add(fast.id, fast.members[0].id, 'singles', True)
+        await asyncio.wait_for(has_singles(fast), 0.3)
+        assert slow.roles[1].id not in slow.members[0]._roles
+
+        await bot.drain_role_changes()
+        states = [
+            await bot.db.get_member_state(guild.id, guild.members[0].id)
+            for guild in (slow, fast)
+        ]
+        await bot.db.close()
+        return states
+
+    states = asyncio.run(scenario())
+    assert [state[2] for state in states] == [1, 1]
+
+
+def test_registry_load_is_retried(bot, monkeypatch):
+    monkeypatch.setattr(bot, 'STORAGE_RETRY_DELAY', 0)
+    load = bot.reaction_roles.load
+    attempts = []
+
+    async def flaky_load():
+        attempts.append(bot.db.ready)
+        if len(attempts) == 1:
+            raise ConnectionError('blip right after connecting')
+        await load()
+
+    monkeypatch.setattr(bot.reaction_roles, 'load', flaky_load)
+
+    async def scenario():
+        await asyncio.wait_for(bot.start_storage(), 1)
+        assert bot.storage_ready.is_set()
+        await bot.db.close()
+
+    asyncio.run(scenario())
+    # Connected once, loaded twice
+    assert attempts == [True, True]
+
+
+def test_lean_mode_refuses_untracked_source_roles(bot, make_guild,
+                                                  monkeypatch):
+    monkeypatch.setattr(bot, 'LEAN_MEMBERS', True)
+    guild = make_guild(members=3)
+    asyncio.run(guild.create_role('captain'))
+    sent = []
+
+    async def send(content):
+        sent.append(content)
+
+    ctx = SimpleNamespace(guild=guild,
+                          send=send,
+                          message=SimpleNamespace(attachments=[]))
+    asyncio.run(
+        bot.bulk_change_role(ctx, [], 'captain', guild.roles[1], add=True))
+    assert sent == [
+        "from:captain isn't supported in lean member mode; only "
+        "from:general, from:singles, from:doubles are tracked."
+    ]
+
+
+def reaction(message_id, emoji, user_id=20, guild_id=5):
+    return SimpleNamespace(message_id=message_id,
+                           emoji=emoji,
+                           user_id=user_id,
+                           guild_id=guild_id,
+                           member=None)
+
+
+def test_reactions_are_routed_without_api_calls(bot):
+    # Role edits are the role queue's business; only routing is checked
+    batches = []
+
+    async def record(batch):
+        batches.append(batch)
+
+    bot.reaction_buffer.process = record
+    rules = SimpleNamespace(id=100,
+                            guild=SimpleNamespace(id=5),
+                            channel=SimpleNamespace(id=10))
+
+    async def scenario():
+        await bot.db.connect()
+        await bot.reaction_roles.register(rules, 'rules')
+        for payload in (
+                reaction(100, '✅'),
+                # Not a role message, a reaction without a role, and the
+                # bot's own reaction
+                reaction(999, '✅'),
+                reaction(100, '👍'),
+                reaction(100, '✅', user_id=bot.client.user.id)):
+            await bot.on_raw_reaction_add(payload)
+        await bot.on_raw_reaction_remove(reaction(100, '✅', user_id=21))
+        await bot.reaction_buffer.join()
+        await bot.db.close()
+
+    asyncio.run(scenario())
+    assert batches == [{
+        (5, 20, 'general'): (True, None),
+        (5, 21, 'general'): (False, None),
+    }]
+
+
+def test_only_prefixed_messages_reach_the_router(monkeypatch):
+    import main
+    routed = []
+
+    async def process_commands(message):
+        routed.append(message.content)
+
+    monkeypatch.setattr(main.client, 'process_commands', process_commands)
+
+    async def scenario():
+        for content in ('hello', '$bothello', '$ bot hello', '$bot hello',
+                        '$bot promote @ana doubles'):
+            await main.client.on_message(SimpleNamespace(content=content))
+
+    asyncio.run(scenario())
+    assert routed == ['$bot hello', '$bot promote @ana doubles']
+
+
+def test_every_command_is_registered():
+    import main
+    names = {command.name for command in main.client.commands}
+    assert {
+        'hello', 'greet', 'database', 'setrules', 'stats', 'export',
+        'promote', 'demote'
+    } <= names
+
+
+def test_unknown_commands_are_not_errors(caplog):
+    import main
+    from discord.ext import commands
+
+    ctx = SimpleNamespace(command=None)
+    asyncio.run(
+        main.on_command_error(ctx, commands.CommandNotFound('no such command')))
+    assert not [record for record in caplog.records
+                if record.levelname == 'ERROR']
@@ -0,0 +1,164 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+from discord.ext import commands
+
+from benchmark import FakeGuild
+from bulk_roles import SUMMARY_FAILURES, BulkRoleJob, MentionedMember
+
+SNOWFLAKE = 10**17
+
+
+def snowflake_guild(members):
+    # Members with Discord-sized IDs
+    return FakeGuild(SNOWFLAKE // 10_000_000, members, 0, 1)
+
+
+def convert(guild, argument):
+    ctx = SimpleNamespace(guild=guild)
+    return asyncio.run(MentionedMember().convert(ctx, argument))
+
+
+def queried(guild, found=()):
+    # Gateway member queries the guild was asked for
+    queries = []
+
+    async def query_members(user_ids, limit, cache):
+        queries.append(user_ids)
+        return [member for member in found if member.id in user_ids]
+
+    guild.query_members = query_members
+    return queries
+
+
+def test_targets_are_mentions_or_ids():
+    guild = snowflake_guild(2)
+    first, second = guild.members
+    queries = queried(guild)
+    assert convert(guild, f'<@{first.id}>') is first
+    assert convert(guild, f'<@!{second.id}>') is second
+    assert convert(guild, str(first.id)) is first
+    assert queries == []
+
+
+def test_words_are_left_for_the_role_name():
+    guild = snowflake_guild(1)
+    # A member nicknamed like a role word
+    guild.members[0].name = 'doubles'
+    queries = queried(guild)
+    for argument in ('doubles', 'team', '@doubles', '<@doubles>', '12'):
+        with pytest.raises(commands.BadArgument):
+            convert(guild, argument)
+    # Never looked up by name
+    assert queries == []
+
+
+def test_uncached_ids_are_fetched():
+    guild = snowflake_guild(1)
+    member = guild.members[0]
+    guild._members.clear()
+    queries = queried(guild, [member])
+    assert convert(guild, f'<@{member.id}>') is member
+    assert queries == [[member.id]]
+    with pytest.raises(commands.MemberNotFound):
+        convert(guild, str(member.id + 1))
+
+
+class FailingMember:
+    # A member whose role edits fail with an HTTP error
+
+    def __init__(self, guild, user_id, status):
+        self.guild = guild
+        self.id = user_id
+        self.display_name = f"failing{user_id}"
+        self.status = status
+        self.attempts = 0
+
+    def get_role(self, role_id):
+        return None
+
+    async def add_roles(self, *roles, reason=None):
+        self.attempts += 1
+        response = SimpleNamespace(status=self.status, reason='')
+        if self.status == 403:
+            raise discord.Forbidden(response, 'Missing Permissions')
+        raise discord.HTTPException(response, '')
+
+
+def run_job(members, role, add, workers=3, per_guild=2):
+    progress = []
+
+    async def on_progress(job):
+        progress.append(job.done)
+
+    async def scenario():
+        job = BulkRoleJob(members,
+                          role,
+                          add,
+                          asyncio.Semaphore(per_guild),
+                          workers=workers,
+                          reason='test')
+        await job.run(on_progress=on_progress)
+        return job
+
+    return asyncio.run(scenario())
+
+
+def test_bulk_add_skips_members_who_have_the_role(make_guild):
+    guild = make_guild(members=20)
+    singles = guild.roles[1]
+    had = [member for member in guild.members if member.get_role(singles.id)]
+    job = run_job(guild.members, singles, add=True)
+    assert all(member.get_role(singles.id) for member in guild.members)
+    assert job.skipped == len(had)
+    assert job.changed == guild.api_calls == 20 - len(had)
+    assert job.done == 20 and not job.failed
+    assert job.summary('Added').startswith(
+        f"Added 'singles' for {job.changed} of 20 members.")
+
+
+def test_bulk_edits_stay_within_the_guild_limit(make_guild):
+    guild = make_guild(members=12, api_latency=0.01)
+    doubles = guild.roles[2]
+    running = 0
+    peak = 0
+    call = guild.api_call
+
+    async def api_call():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await call()
+        running -= 1
+
+    guild.api_call = api_call
+    for member in guild.members:
+        member._roles[doubles.id] = doubles
+    job = run_job(guild.members, doubles, add=False, workers=6, per_guild=2)
+    assert job.changed == 12
+    assert peak == 2
+
+
+def test_bulk_failures_are_reported(make_guild):
+    guild = make_guild(members=2)
+    general = guild.roles[0]
+    failing = [FailingMember(guild, user_id, 500) for user_id in range(12)]
+    job = run_job(failing + guild.members, general, add=True, workers=1)
+    assert len(job.failed) == 12 and not job.forbidden
+    assert job.done == 14
+    summary = job.summary('Added', unknown=['nobody'])
+    assert "12 failed: failing0 (HTTP 500)" in summary
+    assert f"and {12 - SUMMARY_FAILURES} more" in summary
+    assert "1 CSV rows matched no member: nobody" in summary
+
+
+def test_bulk_job_stops_when_forbidden(make_guild):
+    guild = make_guild(members=0)
+    members = [FailingMember(guild, user_id, 403) for user_id in range(10)]
+    job = run_job(members, guild.roles[0], add=True, workers=2)
+    assert job.forbidden
+    # At most one refusal per worker, not one per member
+    assert 1 <= sum(member.attempts for member in members) <= 2
+    assert "Stopped: I don't have permission" in job.summary('Added')
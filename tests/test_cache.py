@@ -0,0 +1,101 @@
+import asyncio
+
+import storage.cache
+from storage import CachedStorage, SQLiteStorage
+from storage.cache import MemberStateCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = MemberStateCache(size=2, ttl=60)
+    cache.put((1, 1), 'a')
+    cache.put((1, 2), 'b')
+    assert cache.get((1, 1)) == 'a'
+    # (1, 2) is now least recently used
+    cache.put((1, 3), 'c')
+    assert cache.get((1, 2)) is None
+    assert cache.get((1, 1)) == 'a'
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_ttl_expiry(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(storage.cache.time, 'monotonic', clock)
+    cache = MemberStateCache(size=10, ttl=5)
+    cache.put((1, 1), 'a')
+    clock.now = 4.9
+    assert cache.peek((1, 1)) == 'a'
+    clock.now = 5.0
+    assert cache.peek((1, 1)) is None
+    assert cache.get((1, 1)) is None
+    assert len(cache) == 0
+
+
+def test_rename_touches_every_guild():
+    cache = MemberStateCache(size=10, ttl=60)
+    cache.put((1, 7), ('ana', 1, 0, 0))
+    cache.put((2, 7), ('ana', 0, 1, 0))
+    cache.put((1, 8), ('ben', 0, 0, 0))
+    cache.rename(7, 'anna')
+    assert cache.get((1, 7)) == ('anna', 1, 0, 0)
+    assert cache.get((2, 7)) == ('anna', 0, 1, 0)
+    assert cache.get((1, 8)) == ('ben', 0, 0, 0)
+
+
+def test_cached_storage_is_write_through(db_path):
+
+    async def scenario():
+        backend = SQLiteStorage(db_path)
+        db = CachedStorage(backend, size=100, ttl=60)
+        await db.connect()
+        await db.upsert_member(1, 7, 'ana', (1, 0, 0))
+        assert await db.get_member_state(1, 7) == ('ana', 1, 0, 0)
+        assert db.cache.hits == 1
+
+        await db.set_member_role(1, 7, 'singles', True)
+        assert await db.get_member_state(1, 7) == ('ana', 1, 1, 0)
+        assert await backend.get_member_state(1, 7) == ('ana', 1, 1, 0)
+
+        # Writes that change nothing don't reach the backend
+        queued = backend.pending_writes
+        await db.set_member_role(1, 7, 'singles', True)
+        await db.upsert_member(1, 7, 'ana', (1, 1, 0))
+        assert backend.pending_writes == queued
+
+        await db.delete_member(1, 7)
+        assert await db.get_member_state(1, 7) is None
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_query_results_follow_writes(db_path):
+
+    async def scenario():
+        db = CachedStorage(SQLiteStorage(db_path), size=100, ttl=60)
+        await db.connect()
+        await db.upsert_member(1, 7, 'ana', (0, 1, 0))
+        assert await db.members_with_role(1, 'singles') == [7]
+        assert await db.members_with_role(1, 'singles') == [7]
+        assert db.queries.hits == 1
+
+        await db.set_member_role(1, 7, 'singles', False)
+        assert await db.members_with_role(1, 'singles') == []
+
+        page = await db.fetch_members_page(1, 0, 10)
+        assert [row[1] for row in page] == ['ana']
+        await db.rename_member(7, 'anna')
+        page = await db.fetch_members_page(1, 0, 10)
+        assert [row[1] for row in page] == ['anna']
+        await db.close()
+
+    asyncio.run(scenario())
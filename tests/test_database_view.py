@@ -0,0 +1,77 @@
+import asyncio
+
+from database_view import (FOOTER, HEADER, MESSAGE_LIMIT, DatabaseView,
+                           format_row, render_page)
+from member_sync import diff_member_flags
+from storage import SQLiteStorage
+
+
+def rows(count, name_length=8):
+    return [(user_id, 'x' * name_length, 1, 0, user_id % 2)
+            for user_id in range(1, count + 1)]
+
+
+def test_render_page_fits_one_message():
+    page = rows(200, name_length=40)
+    text, last_id = render_page(page, "\nPage 1")
+    assert len(text) <= MESSAGE_LIMIT
+    assert text.startswith(HEADER) and text.endswith(FOOTER + "\nPage 1")
+    # Rendered rows run up to last_id, where the next page starts
+    assert text.count('\n') - HEADER.count('\n') - 1 == last_id
+    assert format_row(page[last_id - 1]) in text
+    assert format_row(page[last_id]) not in text
+
+
+def test_render_page_always_shows_a_row():
+    page = rows(1, name_length=3000)
+    text, last_id = render_page(page)
+    assert last_id == 1
+    assert render_page([]) == (HEADER + FOOTER, None)
+
+
+def test_pages_cover_the_table_once(db_path):
+    members = {user_id: ('x' * 30, 1, 0, 1) for user_id in range(1, 121)}
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        await db.apply_member_diff(1, 'x', *diff_member_flags({}, members))
+        view = DatabaseView(db, 1, author_id=7)
+        seen = []
+        pages = []
+        while True:
+            text = await view.render()
+            pages.append(text)
+            seen += [int(line.split(' | ')[0])
+                     for line in text.split('\n')
+                     if line.split(' | ')[0].isdigit()]
+            if view.next_page.disabled:
+                break
+            view.starts.append(view.next_start)
+        assert not view.empty
+        # Back to the first page
+        del view.starts[1:]
+        assert await view.render() == pages[0]
+        assert view.previous_page.disabled
+        await db.close()
+        return seen, pages
+
+    seen, pages = asyncio.run(scenario())
+    assert seen == list(range(1, 121))
+    assert len(pages) > 1
+    assert all(len(page) <= MESSAGE_LIMIT for page in pages)
+    assert f"Page {len(pages)} · " in pages[-1]
+
+
+def test_empty_table(db_path):
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        view = DatabaseView(db, 1, author_id=7)
+        await view.render()
+        await db.close()
+        return view
+
+    view = asyncio.run(scenario())
+    assert view.empty and view.next_page.disabled
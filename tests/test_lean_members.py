@@ -0,0 +1,125 @@
+import asyncio
+
+from lean_members import GuildBitset, MemberBitsets, ROLE_BITS, flags_to_bits
+from member_sync import sync_server_members
+
+
+def test_flags_to_bits():
+    assert flags_to_bits((0, 0, 0)) == 0
+    assert flags_to_bits((1, 0, 1)) == ROLE_BITS['general'] | ROLE_BITS[
+        'doubles']
+
+
+def test_bitset_keeps_ids_sorted():
+    bitset = GuildBitset({30: 1, 10: 2})
+    bitset.set(20, 4)
+    bitset.set(5, 0)
+    assert list(bitset.ids) == [5, 10, 20, 30]
+    assert [bitset.get(user_id) for user_id in (5, 10, 20, 30)] == [0, 2, 4, 1]
+    assert bitset.get(15) is None
+    assert len(bitset) == 4
+
+
+def test_bitset_update_and_remove():
+    bitset = GuildBitset({10: 1, 20: 2})
+    bitset.set(10, 7)
+    assert bitset.get(10) == 7
+    assert len(bitset) == 2
+    bitset.remove(10)
+    bitset.remove(99)
+    assert list(bitset.ids) == [20]
+    assert bitset.get(10) is None
+
+
+def test_bitset_handles_snowflake_sized_ids():
+    user_id = 2**63 + 12345
+    bitset = GuildBitset({user_id: 3})
+    assert bitset.get(user_id) == 3
+
+
+def test_member_bitsets():
+    bits = MemberBitsets()
+    bits.load(1, {10: ('ana', 1, 0, 0), 20: ('ben', 0, 1, 0)})
+    assert bits.loaded(1) and not bits.loaded(2)
+    assert bits.has_role(1, 10, 'general') is True
+    assert bits.has_role(1, 20, 'general') is False
+    # Untracked members, guilds and roles are unknown, not False
+    assert bits.has_role(1, 30, 'general') is None
+    assert bits.has_role(2, 10, 'general') is None
+    assert bits.has_role(1, 10, 'captain') is None
+
+    bits.set_role(1, 20, 'doubles', True)
+    bits.set_role(1, 20, 'singles', False)
+    assert bits.get(1, 20) == ROLE_BITS['doubles']
+    bits.set(1, 30, (0, 0, 1))
+    assert len(bits) == 3
+    bits.remove(1, 30)
+    bits.forget(1)
+    assert len(bits) == 0 and not bits.loaded(1)
+
+
+def test_events_before_loading_dont_count_as_loaded():
+    bits = MemberBitsets()
+    # A member event that arrives before the guild's stored flags are loaded
+    bits.set(1, 10, (0, 1, 0))
+    bits.set_role(1, 30, 'general', True)
+    assert not bits.loaded(1)
+
+    bits.load(1, {10: ('ana', 1, 0, 0), 20: ('ben', 0, 0, 1)})
+    assert bits.loaded(1)
+    assert len(bits) == 3
+    # The event is newer than what was stored
+    assert bits.get(1, 10) == ROLE_BITS['singles']
+    assert bits.get(1, 20) == ROLE_BITS['doubles']
+    assert bits.get(1, 30) == ROLE_BITS['general']
+
+
+def chunkable(guild):
+    # Lean mode fetches a never-synced guild's members without caching them
+    chunks = []
+
+    async def chunk(cache=True):
+        chunks.append(cache)
+        return guild.members
+
+    guild.chunk = chunk
+    return chunks
+
+
+def test_member_event_before_loading_a_new_guild(bot, make_guild):
+    guild = make_guild(members=50)
+    chunks = chunkable(guild)
+    member = guild.members[0]
+
+    async def scenario():
+        await bot.db.connect()
+        # on_member_join lands before on_ready gets to this guild
+        await bot.on_member_join(member)
+        await bot.load_lean_guild(guild)
+        assert await bot.db.count_members(guild.id) == 50
+        await bot.db.close()
+
+    asyncio.run(scenario())
+    assert chunks == [False]
+    assert len(bot.member_bits) == 50
+    assert bot.member_bits.loaded(guild.id)
+
+
+def test_synced_guild_loads_from_storage(bot, make_guild):
+    guild = make_guild(members=50)
+    chunks = chunkable(guild)
+    newcomer = make_guild(members=1).members[0]
+    newcomer.guild = guild
+
+    async def scenario():
+        await bot.db.connect()
+        await sync_server_members(bot.db, guild)
+        # A member write since the sync only makes the watermark stale
+        await bot.on_member_join(newcomer)
+        await bot.load_lean_guild(guild)
+        await bot.db.close()
+
+    asyncio.run(scenario())
+    assert chunks == []
+    assert len(bot.member_bits) == 51
+    assert bot.member_bits.get(guild.id, newcomer.id) is not None
@@ -0,0 +1,53 @@
+import logging
+import sys
+
+from logs import LogfmtFormatter, log_handler
+
+
+def record(msg, *args, exc_info=None, **extra):
+    record = logging.LogRecord('bot', logging.WARNING, __file__, 1, msg, args,
+                               exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_logfmt_line():
+    line = LogfmtFormatter({'shards': '0,1'}).format(
+        record('Synced %s', 'guild', guild=5, seconds=0.25))
+    assert line.startswith('ts=')
+    assert ' level=warning logger=bot shards=0,1 msg="Synced guild" ' in line
+    assert line.endswith(' guild=5 seconds=0.25')
+
+
+def test_values_are_quoted_and_escaped():
+    line = LogfmtFormatter().format(
+        record('x', role='team captain', nick='say "hi"', path='C:\\x',
+               empty=''))
+    assert 'role="team captain"' in line
+    assert r'nick="say \"hi\""' in line
+    # Only quoted values have their backslashes escaped
+    assert 'path=C:\\x' in line
+    assert 'empty=""' in line
+
+
+def test_exceptions_are_one_field():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        exc_info = sys.exc_info()
+    line = LogfmtFormatter().format(record('failed', exc_info=exc_info))
+    assert 'exc="Traceback' in line
+    assert 'ValueError: boom' in line
+
+
+def test_bot_logs_through_the_logfmt_formatter(monkeypatch):
+    import main
+    runs = []
+    monkeypatch.setattr(main.client, 'run',
+                        lambda token, **options: runs.append(options))
+    main.main()
+    [options] = runs
+    assert isinstance(options['log_formatter'], LogfmtFormatter)
+    assert isinstance(options['log_handler'].formatter, LogfmtFormatter)
+    assert options['root_logger'] is True
+    assert isinstance(log_handler(), logging.StreamHandler)
@@ -0,0 +1,126 @@
+import asyncio
+
+from member_sync import (diff_member_flags, flags_fingerprint, member_flags,
+                         sync_server_members)
+from storage import SQLiteStorage
+
+STATE = {
+    1: ('ana', 1, 0, 0),
+    2: ('ben', 0, 1, 1),
+    3: ('cy', 0, 0, 0),
+}
+
+
+def test_fingerprint_ignores_order():
+    reordered = dict(reversed(list(STATE.items())))
+    assert flags_fingerprint(reordered) == flags_fingerprint(STATE)
+
+
+def test_fingerprint_changes_with_state():
+    fingerprint = flags_fingerprint(STATE)
+    assert flags_fingerprint({**STATE, 3: ('cy', 1, 0, 0)}) != fingerprint
+    assert flags_fingerprint({**STATE, 3: ('cyd', 0, 0, 0)}) != fingerprint
+    assert flags_fingerprint({**STATE, 4: ('di', 0, 0, 0)}) != fingerprint
+    assert flags_fingerprint({}) == flags_fingerprint({})
+
+
+def test_diff():
+    live = {1: ('ana', 1, 0, 0), 2: ('ben', 1, 1, 1), 4: ('di', 0, 0, 1)}
+    inserts, updates, deletes = diff_member_flags(STATE, live)
+    assert inserts == [(4, 'di', 0, 0, 1)]
+    assert updates == [('ben', 1, 1, 1, 2)]
+    assert deletes == [3]
+    assert diff_member_flags(STATE, STATE) == ([], [], [])
+
+
+def sync_counts(db):
+    # Number of member diffs written
+    applied = []
+    apply = db.apply_member_diff
+
+    async def counting_apply(*args):
+        applied.append(args)
+        return await apply(*args)
+
+    db.apply_member_diff = counting_apply
+    return applied
+
+
+def test_sync_writes_only_changes(db_path, make_guild):
+    guild = make_guild(members=50)
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        applied = sync_counts(db)
+
+        live = await sync_server_members(db, guild)
+        assert await db.load_member_flags(guild.id) == live
+        assert len(applied) == 1
+
+        # Unchanged: skipped on the watermark
+        await sync_server_members(db, guild)
+        assert len(applied) == 1
+
+        # One member gains a role, one leaves
+        member, leaver = guild.members[:2]
+        member._roles = {role.id: role for role in guild.roles}
+        del guild._members[leaver.id]
+        live = await sync_server_members(db, guild)
+        assert len(applied) == 2
+        _, _, inserts, updates, deletes = applied[-1]
+        assert (inserts, deletes) == ([], [leaver.id])
+        assert [row[-1] for row in updates] == [member.id]
+        assert await db.load_member_flags(guild.id) == live
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_incremental_writes_invalidate_watermark(db_path, make_guild):
+    # A member event recorded after a sync, then undone while the bot was
+    # offline: live state matches the old fingerprint again, but the stored
+    # row doesn't, so the next sync must not be skipped
+    guild = make_guild()
+    member = guild.members[0]
+    singles = guild.roles[1]
+    member._roles.pop(singles.id, None)
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        await sync_server_members(db, guild)
+
+        member._roles[singles.id] = singles
+        await db.upsert_member(guild.id, member.id, member.name,
+                               member_flags(member))
+        member._roles.pop(singles.id)
+
+        await sync_server_members(db, guild)
+        assert await db.get_member_state(guild.id, member.id) == (
+            member.name, *member_flags(member))
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_rename_invalidates_every_guild_of_the_user(db_path, make_guild):
+    guild = make_guild()
+    member = guild.members[0]
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        await sync_server_members(db, guild)
+        assert await db.get_sync_watermark(guild.id)
+        await db.rename_member(member.id, 'renamed')
+        # Stale, but the guild is still known to have been synced
+        assert await db.get_sync_watermark(guild.id) == ''
+
+        # Renamed back while offline
+        await sync_server_members(db, guild)
+        assert (await db.get_member_state(guild.id,
+                                          member.id))[0] == member.name
+        await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,84 @@
+import sqlite3
+
+import pytest
+
+from storage.migrations import MIGRATIONS, migrate
+
+
+def tables(conn):
+    return {
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")
+    }
+
+
+def test_new_database_gets_every_migration():
+    conn = sqlite3.connect(':memory:')
+    migrate(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(
+        MIGRATIONS)
+    assert {'server_members', 'guild_sync_state', 'reaction_roles',
+            'rules_channels'} <= tables(conn)
+    # Running again is a no-op
+    migrate(conn)
+
+
+def test_baseline_database_is_upgraded():
+    # The unversioned schema the bot shipped with, holding data
+    conn = sqlite3.connect(':memory:')
+    MIGRATIONS[0](conn)
+    conn.execute(
+        "INSERT INTO server_members (username, has_general_role) VALUES ('ana', 1)"
+    )
+    conn.execute(
+        "INSERT INTO guild_sync_state VALUES (1, 'fingerprint', 0)")
+    conn.executemany('INSERT INTO reaction_roles VALUES (?, ?, ?, ?, ?)',
+                     [(10, '✅', 'general', 1, 5), (11, '1️⃣', 'singles', 1, 5)])
+    conn.commit()
+
+    migrate(conn)
+
+    # Username-keyed rows can't be attributed to a guild, so the next sync
+    # rebuilds them
+    assert conn.execute('SELECT COUNT(*) FROM server_members').fetchone() == (
+        0, )
+    assert conn.execute('SELECT COUNT(*) FROM guild_sync_state').fetchone() == (
+        0, )
+    assert sorted(
+        conn.execute('SELECT message_id, kind FROM reaction_roles')) == [
+            (10, 'rules'), (11, 'singles_doubles')
+        ]
+
+
+def test_failed_migration_rolls_back():
+    conn = sqlite3.connect(':memory:')
+    MIGRATIONS[0](conn)
+    conn.execute('PRAGMA user_version = 1')
+    # Migration 2 drops server_members, which is already gone here
+    conn.execute('DROP TABLE server_members')
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(conn)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+
+
+def query_plan(conn, sql, params):
+    return ' '.join(row[-1] for row in conn.execute(
+        f'EXPLAIN QUERY PLAN {sql}', params))
+
+
+def test_user_lookups_use_an_index():
+    # Renames and the watermarks they clear look a user up across guilds
+    conn = sqlite3.connect(':memory:')
+    migrate(conn)
+    rename = query_plan(
+        conn, 'UPDATE server_members SET username = ? WHERE user_id = ?',
+        ('ana', 1))
+    guilds = query_plan(
+        conn, '''
+        UPDATE guild_sync_state SET fingerprint = ''
+        WHERE guild_id IN (SELECT guild_id FROM server_members WHERE user_id = ?)
+    ''', (1, ))
+    for plan in (rename, guilds):
+        assert 'SCAN server_members' not in plan
+        assert 'idx_server_members_user' in plan
@@ -0,0 +1,231 @@
+# MongoStorage against a real mongod when MONGO_TEST_URI is set (e.g.
+# mongodb://localhost:27017), otherwise against mongomock behind a thin
+# stand-in for pymongo's asyncio client
+import asyncio
+import inspect
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from pymongo import DeleteOne, UpdateMany, UpdateOne
+
+import storage.mongo
+from member_sync import diff_member_flags
+from storage.mongo import MongoStorage
+
+
+class AsyncCursor:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        return AsyncCursor(self._cursor.sort(*args, **kwargs))
+
+    def limit(self, limit):
+        return AsyncCursor(self._cursor.limit(limit))
+
+    async def __aiter__(self):
+        for doc in self._cursor:
+            yield doc
+
+
+class AsyncMongomock:
+    # The slice of pymongo's AsyncMongoClient/Database/Collection API that
+    # MongoStorage uses, over a mongomock object
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        # mongomock databases and collections are callable, like pymongo's
+        if not inspect.ismethod(attr):
+            return AsyncMongomock(attr)
+        if name == 'get_default_database':
+            return lambda *args: AsyncMongomock(attr(*args))
+        if name == 'find':
+            return lambda *args, **kwargs: AsyncCursor(attr(*args, **kwargs))
+
+        async def call(*args, **kwargs):
+            if name == 'bulk_write':
+                return self._bulk_write(*args)
+            result = attr(*args, **kwargs)
+            return AsyncCursor(result) if name == 'aggregate' else result
+
+        return call
+
+    def __getitem__(self, name):
+        return AsyncMongomock(self._target[name])
+
+    def _bulk_write(self, requests):
+        # mongomock can't take pymongo's current write models, so they are
+        # replayed one by one
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                self._target.update_one(request._filter,
+                                        request._doc,
+                                        upsert=request._upsert)
+            elif isinstance(request, UpdateMany):
+                self._target.update_many(request._filter, request._doc)
+            elif isinstance(request, DeleteOne):
+                self._target.delete_one(request._filter)
+            else:
+                raise TypeError(request)
+
+
+@pytest.fixture
+def mongo_uri(monkeypatch):
+    # A database of its own per test
+    name = f'tennis_test_{uuid.uuid4().hex[:8]}'
+    uri = os.getenv('MONGO_TEST_URI')
+    if uri:
+        return f'{uri.rstrip("/")}/{name}'
+    mongomock = pytest.importorskip('mongomock')
+    monkeypatch.setattr(
+        storage.mongo, 'AsyncMongoClient',
+        lambda uri, **options: AsyncMongomock(mongomock.MongoClient(uri)))
+    return f'mongodb://localhost/{name}'
+
+
+def run(uri, scenario):
+
+    async def main():
+        db = MongoStorage(uri, timeout_ms=2000)
+        await db.connect()
+        try:
+            await scenario(db)
+        finally:
+            await db.client.drop_database(db.db.name)
+            await db.close()
+
+    asyncio.run(main())
+
+
+def test_member_writes(mongo_uri):
+
+    async def scenario(db):
+        await db.upsert_member(1, 7, 'ana', (1, 0, 0))
+        await db.upsert_member(2, 7, 'ana', (0, 0, 0))
+        await db.upsert_member(1, 8, 'ben', (0, 1, 0))
+        await db.set_member_role(1, 7, 'doubles', True)
+        await db.set_member_role(1, 7, 'captain', True)
+        await db.rename_member(7, 'anna')
+        await db.delete_member(1, 8)
+        # Reads flush the queued writes first
+        assert await db.load_member_flags(1) == {7: ('anna', 1, 0, 1)}
+        assert await db.get_member_state(2, 7) == ('anna', 0, 0, 0)
+        assert await db.get_member_state(1, 8) is None
+        assert db.pending_writes == 0
+
+    run(mongo_uri, scenario)
+
+
+def test_writes_are_batched(mongo_uri):
+
+    async def scenario(db):
+        db.flush_interval = 60
+        for user_id in range(5):
+            await db.upsert_member(1, user_id, f'user{user_id}', (0, 0, 0))
+        assert db.pending_writes == 5
+        async with db.batch():
+            await db.upsert_member(1, 99, 'late', (1, 1, 1))
+        assert db.pending_writes == 0
+        assert await db.count_members(1) == 6
+
+    run(mongo_uri, scenario)
+
+
+def test_member_diff_and_watermark(mongo_uri):
+
+    async def scenario(db):
+        members = {user_id: (f'user{user_id}', 0, user_id % 2, 0)
+                   for user_id in range(1, 21)}
+        assert await db.apply_member_diff(
+            1, 'first', *diff_member_flags({}, members)) == 20
+        assert await db.get_sync_watermark(1) == 'first'
+        assert await db.load_member_flags(1) == members
+
+        live = dict(members)
+        del live[1]
+        live[2] = ('user2', 1, 0, 1)
+        live[30] = ('user30', 0, 0, 0)
+        stored = await db.load_member_flags(1)
+        assert await db.apply_member_diff(
+            1, 'second', *diff_member_flags(stored, live)) == 3
+        assert await db.load_member_flags(1) == live
+
+        # Incremental writes clear the watermark, renames in every guild
+        await db.set_member_role(1, 2, 'general', False)
+        assert await db.get_sync_watermark(1) == ''
+        await db.apply_member_diff(2, 'other', [(2, 'user2', 0, 0, 0)], [],
+                                   [])
+        await db.rename_member(2, 'renamed')
+        assert await db.get_sync_watermark(2) == ''
+
+    run(mongo_uri, scenario)
+
+
+def test_keyset_pages_and_role_lookups(mongo_uri):
+
+    async def scenario(db):
+        members = {user_id: (f'user{user_id}', 0, user_id % 3 == 0, 0)
+                   for user_id in range(1, 26)}
+        await db.apply_member_diff(1, 'x', *diff_member_flags({}, members))
+        await db.upsert_member(2, 3, 'other guild', (0, 1, 0))
+
+        seen = []
+        after_id = 0
+        while True:
+            rows = await db.fetch_members_page(1, after_id, 10)
+            if not rows:
+                break
+            seen += rows
+            after_id = rows[-1][0]
+        assert [row[0] for row in seen] == list(range(1, 26))
+        assert seen[2] == (3, 'user3', 0, 1, 0)
+        assert await db.fetch_member_rows(1, 0, 100) == seen
+
+        assert sorted(await db.members_with_role(1, 'singles')) == list(
+            range(3, 26, 3))
+        assert await db.count_members(1) == 25
+        assert sorted(await db.guild_summaries()) == [(1, 25, 0, 8, 0),
+                                                      (2, 1, 0, 1, 0)]
+
+    run(mongo_uri, scenario)
+
+
+def test_reaction_roles_and_rules_channels(mongo_uri):
+
+    async def scenario(db):
+        await db.save_reaction_roles(1, 10, 100, 'rules', {'✅': 'general'})
+        await db.save_reaction_roles(1, 10, 101, 'singles_doubles', {
+            '1️⃣': 'singles',
+            '2️⃣': 'doubles'
+        })
+        # A new message replaces the guild's previous one of its kind
+        await db.save_reaction_roles(1, 10, 102, 'rules', {'✅': 'general'})
+        assert sorted(await db.load_reaction_roles()) == [
+            (101, 'singles_doubles', 1, 10, '1️⃣', 'singles'),
+            (101, 'singles_doubles', 1, 10, '2️⃣', 'doubles'),
+            (102, 'rules', 1, 10, '✅', 'general'),
+        ]
+
+        await db.set_rules_channel(1, 10)
+        await db.set_rules_channel(1, 11)
+        await db.set_rules_channel(2, 20)
+        assert await db.load_rules_channels() == {1: 11, 2: 20}
+
+    run(mongo_uri, scenario)
+
+
+def test_unreachable_server_fails_connect(monkeypatch):
+    if os.getenv('MONGO_TEST_URI'):
+        pytest.skip('only meaningful without a server')
+    db = MongoStorage('mongodb://127.0.0.1:9/tennis', timeout_ms=200)
+    with pytest.raises(Exception):
+        asyncio.run(db.connect())
+    assert not db.ready
@@ -0,0 +1,62 @@
+import asyncio
+
+from reaction_buffer import ReactionBuffer
+
+
+def test_reaction_buffer_keeps_only_the_latest_event():
+    batches = []
+
+    async def process(batch):
+        batches.append(batch)
+
+    async def scenario():
+        buffer = ReactionBuffer(process, window=0.01)
+        buffer.add(1, 10, 'singles', True)
+        buffer.add(1, 10, 'singles', False)
+        buffer.add(1, 10, 'singles', True, 'member')
+        buffer.add(1, 11, 'doubles', True)
+        assert buffer.pending == 2
+        await buffer.join()
+        assert buffer.pending == 0
+
+    asyncio.run(scenario())
+    assert batches == [{
+        (1, 10, 'singles'): (True, 'member'),
+        (1, 11, 'doubles'): (True, None),
+    }]
+
+
+def test_reaction_buffer_starts_full_batches_early():
+    batches = []
+
+    async def process(batch):
+        batches.append(len(batch))
+
+    async def scenario():
+        buffer = ReactionBuffer(process, window=60, max_batch=3)
+        for user_id in range(3):
+            buffer.add(1, user_id, 'general', True)
+        # Well under the 60 s window
+        await asyncio.wait_for(buffer.join(), 1)
+
+    asyncio.run(scenario())
+    assert batches == [3]
+
+
+def test_reaction_buffer_survives_a_failed_batch():
+    batches = []
+
+    async def process(batch):
+        batches.append(batch)
+        if len(batches) == 1:
+            raise RuntimeError('boom')
+
+    async def scenario():
+        buffer = ReactionBuffer(process, window=0.01)
+        buffer.add(1, 10, 'general', True)
+        await buffer.join()
+        buffer.add(1, 11, 'general', True)
+        await buffer.join()
+
+    asyncio.run(scenario())
+    assert len(batches) == 2
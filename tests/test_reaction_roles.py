@@ -0,0 +1,117 @@
+import asyncio
+from types import SimpleNamespace
+
+from reaction_roles import (RULES_MESSAGE, SINGLES_DOUBLES_MESSAGE,
+                            ReactionRoleRegistry)
+from storage import SQLiteStorage
+
+BOT = SimpleNamespace(id=1)
+SOMEONE = SimpleNamespace(id=2)
+
+
+class Channel:
+
+    def __init__(self, history):
+        self.id = 10
+        self.guild = SimpleNamespace(id=5, me=BOT)
+        self.sent = []
+        self.history_reads = 0
+        # Newest first, like Discord
+        self._history = [
+            SimpleNamespace(id=message_id,
+                            author=author,
+                            content=content,
+                            channel=self,
+                            guild=self.guild)
+            for message_id, author, content in history
+        ]
+
+    async def history(self, limit):
+        self.history_reads += 1
+        for message in self._history[:limit]:
+            yield message
+
+    async def send(self, content):
+        self.sent.append(content)
+        return SimpleNamespace(id=200 + len(self.sent),
+                               channel=self,
+                               guild=self.guild)
+
+    async def fetch_message(self, message_id):
+        return SimpleNamespace(id=message_id)
+
+
+def ensure(db_path, channel, runs=1):
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        registry = ReactionRoleRegistry(db)
+        await registry.load()
+        for _ in range(runs):
+            await registry.ensure_messages(channel)
+        # Persisted: a fresh registry knows the same messages
+        reloaded = ReactionRoleRegistry(db)
+        await reloaded.load()
+        await db.close()
+        return reloaded
+
+    return asyncio.run(scenario())
+
+
+def test_existing_messages_are_adopted(db_path):
+    channel = Channel([
+        (103, SOMEONE, RULES_MESSAGE),
+        (102, BOT, RULES_MESSAGE),
+        (101, BOT, RULES_MESSAGE),
+    ])
+    registry = ensure(db_path, channel, runs=2)
+    # Only the missing kind is posted, and history is read once
+    assert channel.sent == [SINGLES_DOUBLES_MESSAGE]
+    assert channel.history_reads == 1
+    assert registry.get(102) == {"✅": "general"}
+    assert registry.get(101) is None and registry.get(103) is None
+    assert registry.get(201) == {"1️⃣": "singles", "2️⃣": "doubles"}
+
+
+def test_new_channel_gets_both_messages(db_path):
+    channel = Channel([])
+    registry = ensure(db_path, channel)
+    assert channel.sent == [RULES_MESSAGE, SINGLES_DOUBLES_MESSAGE]
+    assert registry.get(201) and registry.get(202)
+
+
+def message(message_id, guild_id=5, channel_id=10):
+    return SimpleNamespace(id=message_id,
+                           guild=SimpleNamespace(id=guild_id),
+                           channel=SimpleNamespace(id=channel_id))
+
+
+def test_registry_routes_by_message_id(db_path):
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        await db.connect()
+        registry = ReactionRoleRegistry(db)
+        await registry.load()
+        await registry.register(message(100), 'rules')
+        await registry.register(message(101), 'singles_doubles')
+        await registry.register(message(300, guild_id=6), 'rules')
+        assert registry.get(100) == {'✅': 'general'}
+        assert registry.get(101) == {'1️⃣': 'singles', '2️⃣': 'doubles'}
+        assert registry.get(999) is None
+
+        # A new rules message replaces the guild's old one, and only that
+        await registry.register(message(102), 'rules')
+        assert registry.get(100) is None
+        assert registry.get(102) == {'✅': 'general'}
+        assert registry.get(300) == {'✅': 'general'}
+
+        reloaded = ReactionRoleRegistry(db)
+        await reloaded.load()
+        await db.close()
+        return reloaded
+
+    reloaded = asyncio.run(scenario())
+    assert [reloaded.get(message_id) is not None
+            for message_id in (100, 101, 102, 300)] == [False, True, True, True]
@@ -0,0 +1,50 @@
+import asyncio
+
+from benchmark import FakeRole
+from role_index import RoleIndex, role_index
+
+
+def test_lookups_by_name_and_id(make_guild):
+    guild = make_guild(members=0)
+    general = guild.roles[0]
+    index = RoleIndex()
+    assert index.get(guild, 'general') is general
+    assert index.get_by_id(guild, general.id) is general
+    assert index.get(guild, 'captain') is None
+    # The first of two roles with one name wins, like discord.utils.get
+    guild.roles.append(FakeRole(1, 'general'))
+    index.invalidate(guild)
+    assert index.get(guild, 'general') is general
+
+
+def rename_offline(guild, name, new_name):
+    # discord.py hands over new Role objects; no role event arrives
+    old = next(role for role in guild.roles if role.name == name)
+    guild.roles = [role for role in guild.roles if role is not old]
+    guild.roles.append(FakeRole(old.id, new_name))
+    return old.id
+
+
+def test_role_index_is_rebuilt_after_reconnecting(bot, make_guild):
+    guild = make_guild(members=0)
+    bot.client.guilds = [guild]
+    bot.client.get_channel = lambda channel_id: None
+    bot.storage_ready.set()
+
+    async def scenario():
+        await bot.db.connect()
+        assert role_index.get(guild, 'singles') is not None
+        rename_offline(guild, 'singles', 'singles-ladder')
+        # A fresh IDENTIFY ends in on_ready
+        await bot.on_ready()
+        assert role_index.get(guild, 'singles') is None
+        assert role_index.get(guild, 'singles-ladder') is not None
+
+        # A guild that was unavailable during an outage comes back
+        role_id = rename_offline(guild, 'singles-ladder', 'ladder')
+        await bot.on_guild_available(guild)
+        assert role_index.get(guild, 'singles-ladder') is None
+        assert role_index.get_by_id(guild, role_id).name == 'ladder'
+        await bot.db.close()
+
+    asyncio.run(scenario())
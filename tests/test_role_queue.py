@@ -0,0 +1,65 @@
+import asyncio
+
+from role_queue import RoleMutationQueue
+
+
+def test_role_queue_coalesces_changes(make_guild):
+    guild = make_guild(members=1)
+    member = guild.members[0]
+    general, singles, doubles = guild.roles
+    member._roles = {general.id: general}
+    applied = []
+
+    async def on_applied(member, added, removed):
+        applied.append((added, removed))
+
+    async def scenario():
+        queue = RoleMutationQueue(on_applied=on_applied, delay=0.01)
+        # Net zero: added and removed again before the edit runs
+        queue.add(member, singles)
+        queue.remove(member, singles)
+        # Two changes become one edit of the role list
+        queue.add(member, doubles)
+        queue.remove(member, general)
+        assert queue.pending == 1
+        await queue.join()
+
+    asyncio.run(scenario())
+    assert guild.api_calls == 1
+    assert set(member._roles) == {doubles.id}
+    assert applied == [([doubles], [general])]
+
+
+def test_role_queue_skips_net_zero_changes(make_guild):
+    guild = make_guild(members=1)
+    member = guild.members[0]
+    singles = guild.roles[1]
+    member._roles = {}
+
+    async def scenario():
+        queue = RoleMutationQueue(delay=0.01)
+        for _ in range(3):
+            queue.add(member, singles)
+            queue.remove(member, singles)
+        await queue.join()
+
+    asyncio.run(scenario())
+    assert guild.api_calls == 0
+
+
+def test_role_queue_edits_each_member(make_guild):
+    guild = make_guild(members=2)
+    first, second = guild.members
+    singles = guild.roles[1]
+    first._roles = {}
+    second._roles = {}
+
+    async def scenario():
+        queue = RoleMutationQueue(delay=0)
+        tasks = [queue.add(first, singles), queue.add(second, singles)]
+        await asyncio.wait(tasks)
+
+    asyncio.run(scenario())
+    # One add_roles call per member
+    assert guild.api_calls == 2
+    assert singles.id in first._roles and singles.id in second._roles
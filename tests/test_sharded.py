@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from storage import (SQLiteStorage, ShardedStorage, shard_for, shard_path,
+                     stored_shard_count)
+
+
+def test_first_start_seeds_shards_from_the_single_database(db_path):
+    guilds = [guild_id << 22 for guild_id in range(1, 5)]
+
+    async def scenario():
+        single = SQLiteStorage(db_path)
+        await single.connect()
+        for guild_id in guilds:
+            await single.upsert_member(guild_id, 7, 'ana', (1, 0, 0))
+        await single.close()
+
+        db = ShardedStorage(db_path, 2, [0, 1])
+        await db.connect()
+        for guild_id in guilds:
+            shard = db.shards[shard_for(guild_id, 2)]
+            assert await shard.count_members(guild_id) == 1
+        # Every guild once, across both shard files
+        assert sorted(row[0]
+                      for row in await db.guild_summaries()) == guilds
+        await db.close()
+
+    asyncio.run(scenario())
+    assert stored_shard_count(db_path) == 2
+
+
+def test_another_shard_count_is_refused(db_path):
+
+    async def scenario():
+        db = ShardedStorage(db_path, 2, [0])
+        await db.connect()
+        await db.close()
+
+        db = ShardedStorage(db_path, 4, [0])
+        with pytest.raises(ValueError, match='shard 0 of 2'):
+            await db.connect()
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_other_shards_guilds_are_refused(db_path):
+
+    async def scenario():
+        db = ShardedStorage(db_path, 2, [0])
+        await db.connect()
+        guild_id = 1 << 22  # shard 1
+        with pytest.raises(LookupError):
+            await db.count_members(guild_id)
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_shard_path():
+    assert shard_path('data/tennis.db', 3) == 'data/tennis.shard-3.db'
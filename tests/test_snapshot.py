@@ -0,0 +1,101 @@
+import asyncio
+import gzip
+import io
+
+import pytest
+
+from member_sync import diff_member_flags, flags_fingerprint
+from snapshot import export_members, import_members, snapshot_format
+from storage import SQLiteStorage
+
+GUILDS = {
+    1: {user_id: (f'user{user_id}', user_id % 2, 0, 1)
+        for user_id in range(1, 251)},
+    2: {7: ('ana', 1, 1, 0)},
+}
+
+
+async def seeded(path):
+    db = SQLiteStorage(path)
+    await db.connect()
+    for guild_id, members in GUILDS.items():
+        await db.apply_member_diff(guild_id, 'seed',
+                                   *diff_member_flags({}, members))
+    return db
+
+
+def round_trip(tmp_path, fmt, monkeypatch):
+    # Small pages so the export and import both span several of them
+    monkeypatch.setattr('snapshot.PAGE_ROWS', 100)
+
+    async def scenario():
+        source = await seeded(str(tmp_path / 'source.db'))
+        file = io.BytesIO()
+        written = await export_members(source, file, fmt, [1, 2])
+        assert written == 251
+        await source.close()
+
+        target = SQLiteStorage(str(tmp_path / 'target.db'))
+        await target.connect()
+        # Rows the snapshot doesn't have are removed, changed ones restored
+        await target.upsert_member(1, 999, 'extra', (0, 0, 0))
+        await target.upsert_member(1, 1, 'user1', (0, 0, 0))
+        file.seek(0)
+        changed = await import_members(target, file, fmt)
+        assert changed == {1: 251, 2: 1}
+        for guild_id, members in GUILDS.items():
+            assert await target.load_member_flags(guild_id) == members
+            # The next sync of unchanged guilds is skipped
+            assert await target.get_sync_watermark(
+                guild_id) == flags_fingerprint(members)
+
+        file.seek(0)
+        assert await import_members(target, file, fmt, guild_id=2) == {2: 0}
+        await target.close()
+
+    asyncio.run(scenario())
+
+
+def test_csv_round_trip(tmp_path, monkeypatch):
+    round_trip(tmp_path, 'csv.gz', monkeypatch)
+
+
+def test_parquet_round_trip(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    round_trip(tmp_path, 'parquet', monkeypatch)
+
+
+def test_import_rejects_ungrouped_rows(tmp_path):
+    file = io.BytesIO()
+    with gzip.GzipFile(fileobj=file, mode='wb') as compressed:
+        compressed.write(b'guild_id,user_id,username,has_general_role,'
+                         b'has_singles_role,has_doubles_role\n'
+                         b'1,1,ana,0,0,0\n2,1,ana,0,0,0\n1,2,ben,0,0,0\n')
+    file.seek(0)
+
+    async def scenario():
+        db = await seeded(str(tmp_path / 'tennis.db'))
+        with pytest.raises(ValueError):
+            await import_members(db, file, 'csv.gz')
+        # Refused before anything was written
+        for guild_id, members in GUILDS.items():
+            assert await db.load_member_flags(guild_id) == members
+        # One guild's rows are a single run once the others are left out
+        file.seek(0)
+        assert await import_members(db, file, 'csv.gz', guild_id=1) == {
+            1: 250
+        }
+        assert await db.load_member_flags(1) == {
+            1: ('ana', 0, 0, 0),
+            2: ('ben', 0, 0, 0)
+        }
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_format():
+    assert snapshot_format('members.PARQUET') == 'parquet'
+    assert snapshot_format('out/members.csv.gz') == 'csv.gz'
+    with pytest.raises(ValueError):
+        snapshot_format('members.csv')
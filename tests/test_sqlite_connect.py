@@ -0,0 +1,36 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import storage.sqlite
+from storage import SQLiteStorage
+from storage.migrations import MIGRATIONS, migrate
+
+
+def test_connect_retries_from_scratch(db_path, monkeypatch):
+    # A first attempt that fails mid-setup (e.g. "database is locked") must
+    # not leave a half-set-up connection for the retry
+    attempts = []
+
+    def flaky_migrate(conn):
+        attempts.append(conn)
+        if len(attempts) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        migrate(conn)
+
+    monkeypatch.setattr(storage.sqlite, 'migrate', flaky_migrate)
+
+    async def scenario():
+        db = SQLiteStorage(db_path)
+        with pytest.raises(sqlite3.OperationalError):
+            await db.connect()
+        assert not db.ready
+        await db.connect()
+        assert await db.execute('PRAGMA user_version') == [(len(MIGRATIONS),
+                                                            )]
+        assert await db.count_members(1) == 0
+        await db.close()
+
+    asyncio.run(scenario())
+    assert len(attempts) == 2